@@ -3,11 +3,16 @@
 
 from airflow import DAG
 from airflow.operators.python import PythonOperator
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from google.cloud import storage, bigquery, datacatalog_v1
-from google.api_core.exceptions import NotFound, AlreadyExists
+from google.api_core.exceptions import NotFound, AlreadyExists, TooManyRequests, ResourceExhausted
 import pandas as pd
+import hashlib
 import io
+import json
+import threading
+import time
 from google.iam.v1 import policy_pb2
 
 # ---------------------------------------------------------------------------------------------------------------------------------
@@ -20,6 +25,137 @@ SHEET_PATH = "data/masking_policies.csv"         #Completar: Carpeta y nombre de
 BQ_DATASET = "Data_Adduntia_Sheets"              #Completar: Dataset en donde se alojara la tabla con las reglas de Masking.
 BQ_TABLE = "masking_policies"                    #Completar: Nombre de la tabla que contendra las reglas de Masking.
 BQ_AUDIT_TABLE = "masking_auditoria"             #Completar: Nombre de la tabla de auditoría que registrara las implementaciones de Masking.
+MODO_EJECUCION = "reconcile"                     #Completar: "reconcile" (aplica solo las diferencias) o "full" (elimina y recrea todas las politicas).
+TAXONOMY_DISPLAY_NAME = "Masking"                #Nombre de la taxonomía administrada por el proceso.
+POLICY_TAG_CACHE_PATH = "/tmp/masking_policy_tags.json"  #Opcional: cache local de policy tags entre corridas ("" para deshabilitar).
+MAX_WORKERS = 8                                  #Completar: Cantidad de llamadas concurrentes a las APIs (1 = ejecución secuencial).
+API_RATE_LIMITS = {                              #Completar: Llamadas por segundo permitidas por familia de API.
+    "bigquery": 10,                              # get_table / update_table
+    "policy_tag": 5,                             # list / create / delete de taxonomías y policy tags
+    "iam": 10,                                   # get_iam_policy / set_iam_policy
+}
+API_MAX_RETRIES = 5                              #Reintentos ante errores de cuota (429) con backoff exponencial.
+CLEAR_SCOPES = [f"{PROJECT_ID}.{BQ_DATASET}"]    #Completar: Datasets ("proyecto.dataset") o regiones ("proyecto.region-us") donde se buscan columnas con policy tags.
+AUDIT_CHUNK_ROWS = 500                           #Máximo de filas de auditoría por insert_rows_json.
+AUDIT_CHUNK_BYTES = 5 * 1024 * 1024              #Máximo de bytes por insert_rows_json (la API admite hasta 10 MB por request).
+AUDIT_LOAD_JOB_MIN_ROWS = 10000                  #Los lotes de auditoría de este tamaño o mayores se escriben con un load job.
+SHARD_POR = "dataset"                            #Completar: "dataset" (un shard por proyecto y dataset) o "tablas" (grupos de SHARD_TABLAS tablas).
+SHARD_TABLAS = 50                                #Tablas por shard cuando SHARD_POR = "tablas".
+SHARD_MAX_PARALELOS = 4                          #Shards en ejecución simultánea (cada uno aplica API_RATE_LIMITS por su cuenta).
+SHARD_RETRIES = 2                                #Reintentos de cada shard fallido, independientes del resto.
+ESQUEMA_POLICY_TAGS = "columna"                  #Completar: "columna" (un policy tag por columna) o "usuarios" (un policy tag por conjunto de restricted_users).
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Ejecución concurrente con control de cuota (un token bucket por familia de API y un pool de hilos):
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                espera = (1 - self.tokens) / self.rate
+            time.sleep(espera)
+
+RATE_LIMITERS = {family: TokenBucket(rate) for family, rate in API_RATE_LIMITS.items()}
+TABLE_LOCKS = {}
+TABLE_LOCKS_GUARD = threading.Lock()
+
+def call_api(family, fn, *args, **kwargs):
+    for intento in range(API_MAX_RETRIES + 1):
+        RATE_LIMITERS[family].acquire()
+        try:
+            return fn(*args, **kwargs)
+        except (TooManyRequests, ResourceExhausted) as e:
+            if intento == API_MAX_RETRIES:
+                raise
+            espera = min(2 ** intento, 32)
+            print(f"Cuota excedida en {family}, reintento en {espera}s: {e}")
+            time.sleep(espera)
+
+def table_lock(table_ref):
+    # Las escrituras sobre una misma tabla se serializan para que los updates de schema no se pisen
+    with TABLE_LOCKS_GUARD:
+        return TABLE_LOCKS.setdefault(table_ref, threading.RLock())
+
+def run_concurrently(fn, items):
+    items = list(items)
+    if MAX_WORKERS <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(fn, items))
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Escritura de auditoría con buffer (bloques acotados por filas y bytes, load job para lotes grandes). Usado como
+# context manager escribe lo acumulado aunque la tarea falle a mitad de camino:
+
+class AuditWriter:
+    def __init__(self, bq_client, table_ref):
+        self.bq_client = bq_client
+        self.table_ref = table_ref
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.filas_escritas = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        return False
+
+    def extend(self, rows):
+        with self.lock:
+            for row in rows:
+                self.buffer.append(row)
+                self.buffer_bytes += len(json.dumps(row))
+            if len(self.buffer) >= AUDIT_CHUNK_ROWS or self.buffer_bytes >= AUDIT_CHUNK_BYTES:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        rows, self.buffer, self.buffer_bytes = self.buffer, [], 0
+        if not rows:
+            return
+        if len(rows) >= AUDIT_LOAD_JOB_MIN_ROWS:
+            job_config = bigquery.LoadJobConfig(
+                schema=self.bq_client.get_table(self.table_ref).schema,
+                write_disposition="WRITE_APPEND",
+            )
+            self.bq_client.load_table_from_json(rows, self.table_ref, job_config=job_config).result()
+        else:
+            for chunk in self._chunks(rows):
+                errors = self.bq_client.insert_rows_json(self.table_ref, chunk)
+                if errors:
+                    print(f"Error al insertar auditoría: {errors}")
+        self.filas_escritas += len(rows)
+
+    def _chunks(self, rows):
+        chunk, chunk_bytes = [], 0
+        for row in rows:
+            row_bytes = len(json.dumps(row))
+            if chunk and (len(chunk) >= AUDIT_CHUNK_ROWS or chunk_bytes + row_bytes > AUDIT_CHUNK_BYTES):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(row)
+            chunk_bytes += row_bytes
+        if chunk:
+            yield chunk
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 # Descargar el sheet desde GCS:
@@ -59,6 +195,211 @@ def load_config_to_bq(**kwargs):
 
     print(f"Configuración cargada exitosamente en {table_ref}")
 
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Funciones auxiliares compartidas por el modo "full" y el modo "reconcile":
+
+def parse_restricted_users(value):
+    return sorted({u.strip() for u in (value or "").split(",") if u.strip()})
+
+def policy_tag_for_rule(table_id, column_name, restricted_users):
+    # Nombre y descripción del policy tag de una regla. Con ESQUEMA_POLICY_TAGS = "usuarios" todas las columnas con el
+    # mismo conjunto normalizado de usuarios comparten un tag (y una única política IAM); el nombre es un hash del
+    # conjunto porque los display names de Data Catalog admiten hasta 200 caracteres.
+    if ESQUEMA_POLICY_TAGS == "usuarios":
+        clave = ",".join(restricted_users)
+        display_name = f"usuarios_{hashlib.sha1(clave.encode('utf-8')).hexdigest()[:16]}"
+        return display_name, f"Columnas ocultas para: {clave}"[:2000]
+    # Los display names no admiten puntos: los campos anidados ("payload.user.email") usan "_" como separador
+    return f"{table_id}_{column_name.replace('.', '_')}_mask", f"Oculta columna {column_name} en {table_id}"
+
+def read_masking_rules(bq_client):
+    query = f"""
+    SELECT project_id, dataset_id, table_id, column_name, restricted_users
+    FROM `{PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}`
+    """
+    reglas = {}
+    for row in bq_client.query(query).result():
+        key = (row.project_id, row.dataset_id, row.table_id, row.column_name)
+        restricted_users = parse_restricted_users(row.restricted_users)
+        policy_tag_display_name, description = policy_tag_for_rule(row.table_id, row.column_name, restricted_users)
+        reglas[key] = {
+            "policy_tag_display_name": policy_tag_display_name,
+            "description": description,
+            "restricted_users": restricted_users,
+        }
+    return reglas
+
+def get_or_create_taxonomy(datacatalog_client):
+    parent = f"projects/{PROJECT_ID}/locations/{LOCATION}"
+    for taxonomy in call_api("policy_tag", lambda: list(datacatalog_client.list_taxonomies(parent=parent))):
+        if taxonomy.display_name == TAXONOMY_DISPLAY_NAME:
+            return taxonomy.name
+    taxonomy = datacatalog_v1.Taxonomy(
+        display_name=TAXONOMY_DISPLAY_NAME,
+        activated_policy_types=[datacatalog_v1.Taxonomy.PolicyType.FINE_GRAINED_ACCESS_CONTROL],
+    )
+    taxonomy = call_api("policy_tag", datacatalog_client.create_taxonomy, parent=parent, taxonomy=taxonomy)
+    print(f"Creada nueva taxonomía: {taxonomy.name}")
+    return taxonomy.name
+
+def taxonomy_version(datacatalog_client, taxonomy_name):
+    taxonomy = call_api("policy_tag", datacatalog_client.get_taxonomy, name=taxonomy_name)
+    return f"{taxonomy_name}@{taxonomy.taxonomy_timestamps.update_time}"
+
+def list_policy_tags_by_name(datacatalog_client, taxonomy_name):
+    policy_tags = call_api("policy_tag", lambda: list(datacatalog_client.list_policy_tags(parent=taxonomy_name)))
+    return {t.display_name: t.name for t in policy_tags}
+
+def load_policy_tag_registry(datacatalog_client, taxonomy_name):
+    # Registro en memoria display_name -> resource name: la taxonomía se lista una sola vez por corrida.
+    # Si el cache local corresponde a la misma versión de la taxonomía se evita el listado.
+    if POLICY_TAG_CACHE_PATH:
+        try:
+            with open(POLICY_TAG_CACHE_PATH) as f:
+                cache = json.load(f)
+            if cache.get("version") == taxonomy_version(datacatalog_client, taxonomy_name):
+                print(f"Policy Tags leídos del cache local: {len(cache['tags'])}")
+                return cache["tags"]
+        except (OSError, ValueError, KeyError):
+            pass
+    return list_policy_tags_by_name(datacatalog_client, taxonomy_name)
+
+def save_policy_tag_registry(datacatalog_client, taxonomy_name, registry):
+    if not POLICY_TAG_CACHE_PATH:
+        return
+    try:
+        with open(POLICY_TAG_CACHE_PATH, "w") as f:
+            json.dump({"version": taxonomy_version(datacatalog_client, taxonomy_name), "tags": registry}, f)
+    except OSError as e:
+        print(f"No se pudo guardar el cache de Policy Tags: {e}")
+
+def get_or_create_policy_tag(datacatalog_client, taxonomy_name, registry, display_name, description):
+    if display_name in registry:
+        return registry[display_name]
+    try:
+        policy_tag = datacatalog_v1.PolicyTag(display_name=display_name, description=description)
+        policy_tag_obj = call_api("policy_tag", datacatalog_client.create_policy_tag, parent=taxonomy_name, policy_tag=policy_tag)
+        registry[display_name] = policy_tag_obj.name
+        print(f"Policy Tag creado: {policy_tag_obj.name}")
+    except AlreadyExists:
+        # El registro estaba desactualizado (cache viejo o cambio externo): se vuelve a listar la taxonomía
+        registry.update(list_policy_tags_by_name(datacatalog_client, taxonomy_name))
+    return registry[display_name]
+
+def discover_tagged_columns(bq_client, scopes=None):
+    # Una única consulta a INFORMATION_SCHEMA.COLUMN_FIELD_PATHS (UNION ALL de todos los datasets/proyectos)
+    # reemplaza el get_table de cada tabla: solo se devuelven las tablas que realmente tienen policy tags.
+    # Todos los scopes deben estar en la misma ubicación (LOCATION) para poder consultarse juntos.
+    # Se devuelven rutas de campo ("payload.user.email"), por lo que también se encuentran los campos anidados.
+    scopes = scopes or CLEAR_SCOPES
+    query = "\nUNION ALL\n".join(
+        f"""SELECT table_catalog, table_schema, table_name, field_path
+        FROM `{scope}.INFORMATION_SCHEMA.COLUMN_FIELD_PATHS`
+        WHERE ARRAY_LENGTH(policy_tags) > 0"""
+        for scope in scopes
+    )
+    columnas_por_tabla = {}
+    for row in bq_client.query(query, location=LOCATION).result():
+        table_ref = f"{row.table_catalog}.{row.table_schema}.{row.table_name}"
+        columnas_por_tabla.setdefault(table_ref, set()).add(row.field_path)
+    return columnas_por_tabla
+
+def build_restrictions(reglas, policy_tags):
+    # Usuarios restringidos por policy tag, calculados en una sola pasada sobre las reglas
+    restricciones = {}
+    for regla in reglas.values():
+        policy_tag_name = policy_tags.get(regla["policy_tag_display_name"])
+        if policy_tag_name:
+            restricciones.setdefault(policy_tag_name, set()).update(regla["restricted_users"])
+    return restricciones
+
+def build_restricted_policy(policy, restricted_members):
+    # Bindings deseadas: las actuales sin los usuarios restringidos. Devuelve None si la política ya es correcta.
+    new_policy = policy_pb2.Policy()
+    new_policy.CopyFrom(policy)
+    del new_policy.bindings[:]
+    modificada = False
+    for binding in policy.bindings:
+        allowed_members = [m for m in binding.members if m not in restricted_members]
+        modificada = modificada or len(allowed_members) != len(binding.members)
+        if allowed_members:
+            new_binding = new_policy.bindings.add()
+            new_binding.CopyFrom(binding)
+            del new_binding.members[:]
+            new_binding.members.extend(allowed_members)
+    return new_policy if modificada else None
+
+def apply_iam_policies(datacatalog_client, restricciones):
+    # Un get_iam_policy por tag; set_iam_policy solo cuando las bindings cambian. El etag copiado de la política
+    # leída hace que una modificación concurrente falle en lugar de pisarse.
+    def restringir(item):
+        policy_tag_name, restricted_users = item
+        restricted_members = {f"user:{u}" for u in restricted_users}
+        policy = call_api("iam", datacatalog_client.get_iam_policy, request={"resource": policy_tag_name})
+        new_policy = build_restricted_policy(policy, restricted_members)
+        if new_policy is None:
+            return False
+        call_api("iam", datacatalog_client.set_iam_policy, request={"resource": policy_tag_name, "policy": new_policy})
+        print(f"Acceso restringido a {sorted(restricted_users)} en {policy_tag_name}")
+        return True
+
+    return sum(run_concurrently(restringir, restricciones.items()))
+
+def audit_row(taxonomy_name, policy_tag_name, project_id, dataset_id, table_id, column_name, restricted_users):
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "taxonomy_name": taxonomy_name,
+        "policy_tag_name": policy_tag_name,
+        "project_id": project_id,
+        "dataset_id": dataset_id,
+        "table_id": table_id,
+        "column_name": column_name,
+        "restricted_users": ",".join(restricted_users),
+    }
+
+def field_path_index(campos, prefijo=""):
+    # Índice ruta con puntos ("payload.user.email") -> campo en formato API, armado en una sola pasada recursiva.
+    # Los valores son los mismos dicts del schema: editar un campo del índice edita el schema completo.
+    indice = {}
+    for campo in campos:
+        ruta = f"{prefijo}{campo['name']}"
+        indice[ruta] = campo
+        if campo.get("fields"):
+            indice.update(field_path_index(campo["fields"], f"{ruta}."))
+    return indice
+
+def leaf_policy_tags(table):
+    # Policy tag actual (o None) de cada campo hoja, incluidos los anidados en RECORDs: son los únicos que aceptan tags
+    indice = field_path_index([field.to_api_repr() for field in table.schema])
+    return {
+        ruta: ((campo.get("policyTags") or {}).get("names") or [None])[0]
+        for ruta, campo in indice.items() if not campo.get("fields")
+    }
+
+def rewrite_table_schema(bq_client, table_ref, cambios, table=None):
+    # cambios: ruta del campo -> policy tag (None lo quita). Se edita la representación API del schema a través del
+    # índice de rutas, así cada cambio se resuelve sin recorrer el schema, los demás atributos (description, mode,
+    # maxLength, defaultValueExpression, campos anidados, ...) quedan intactos y la tabla se reescribe una sola vez
+    with table_lock(table_ref):
+        if table is None:
+            table = call_api("bigquery", bq_client.get_table, table_ref)
+        campos = [field.to_api_repr() for field in table.schema]
+        indice = field_path_index(campos)
+        for ruta, policy_tag_name in cambios.items():
+            campo = indice.get(ruta)
+            if campo is None:
+                print(f"Columna inexistente, se omite: {table_ref}.{ruta}")
+                continue
+            if campo.get("fields"):
+                print(f"Los policy tags solo se aplican a campos hoja, se omite el RECORD: {table_ref}.{ruta}")
+                continue
+            if policy_tag_name:
+                campo["policyTags"] = {"names": [policy_tag_name]}
+            else:
+                campo.pop("policyTags", None)
+        table.schema = [bigquery.SchemaField.from_api_repr(campo) for campo in campos]
+        call_api("bigquery", bq_client.update_table, table, ["schema"])
+
 # ---------------------------------------------------------------------------------------------------------------------------------
 # Eliminar taxonomías/policy tags anteriores:
 
@@ -67,51 +408,44 @@ def clear_existing_policies(**kwargs):
     datacatalog_client = datacatalog_v1.PolicyTagManagerClient()
 
     print("Eliminando Policy Tags de las tablas existentes...")
-    tables = list(bq_client.list_tables(f"{PROJECT_ID}.{BQ_DATASET}"))
-    for table_item in tables:
-        table_ref = f"{PROJECT_ID}.{BQ_DATASET}.{table_item.table_id}"
-        table = bq_client.get_table(table_ref)
-        new_schema = []
-        modified = False
-
-        for field in table.schema:
-            if getattr(field, "policy_tags", None) and field.policy_tags.names:
-                print(f"Quitando policy tag de columna: {field.name} en {table_ref}")
-                clean_field = bigquery.SchemaField(
-                    name=field.name,
-                    field_type=field.field_type,
-                    mode=field.mode,
-                    description=field.description,
-                    fields=field.fields,
-                )
-                new_schema.append(clean_field)
-                modified = True
-            else:
-                new_schema.append(field)
 
-        if modified:
-            table.schema = new_schema
-            bq_client.update_table(table, ["schema"])
-            print(f"Policy tags eliminados en {table_ref}")
+    # Solo se leen y reescriben las tablas que INFORMATION_SCHEMA reporta con policy tags
+    tablas_con_tags = discover_tagged_columns(bq_client)
+    print(f"Tablas con policy tags: {len(tablas_con_tags)}")
+
+    def limpiar_tabla(item):
+        table_ref, columnas = item
+        for column_name in sorted(columnas):
+            print(f"Quitando policy tag de columna: {column_name} en {table_ref}")
+        rewrite_table_schema(bq_client, table_ref, {column_name: None for column_name in columnas})
+        print(f"Policy tags eliminados en {table_ref}")
+
+    run_concurrently(limpiar_tabla, tablas_con_tags.items())
 
     print("Eliminando taxonomías anteriores...")
     parent = f"projects/{PROJECT_ID}/locations/{LOCATION}"
-    for taxonomy in datacatalog_client.list_taxonomies(parent=parent):
+
+    def eliminar_taxonomia(taxonomy):
         try:
-            datacatalog_client.delete_taxonomy(name=taxonomy.name)
+            call_api("policy_tag", datacatalog_client.delete_taxonomy, name=taxonomy.name)
             print(f"Taxonomía eliminada: {taxonomy.display_name}")
         except Exception as e:
             print(f"No se pudo eliminar {taxonomy.display_name}: {e}")
 
+    taxonomies = call_api("policy_tag", lambda: list(datacatalog_client.list_taxonomies(parent=parent)))
+    run_concurrently(eliminar_taxonomia, taxonomies)
 
-# ---------------------------------------------------------------------------------------------------------------------------------
-# Aplicar políticas y registrar auditoría:
-
-def apply_masking_from_config(**kwargs):
-    bq_client = bigquery.Client(project=PROJECT_ID)
-    datacatalog_client = datacatalog_v1.PolicyTagManagerClient()
 
-    # Crear tabla de auditoría si no existe
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Aplicar políticas y registrar auditoría, repartido en shards (dynamic task mapping):
+# 1. Planifica_masking crea una sola vez los policy tags faltantes y arma los shards (por proyecto y dataset o por grupos
+#    de SHARD_TABLAS tablas).
+# 2. Aplica_masking se expande en una tarea por shard; cada una es idempotente (solo reescribe las columnas que no tienen
+#    el tag correcto) y se reintenta por separado.
+# 3. Consolida_auditoria escribe en una sola pasada las filas de auditoría devueltas por los shards (XCom). Un shard
+#    reintentado reemplaza su XCom, por lo que la auditoría no se duplica.
+
+def ensure_audit_table(bq_client):
     audit_table_ref = f"{PROJECT_ID}.{BQ_DATASET}.{BQ_AUDIT_TABLE}"
     try:
         bq_client.get_table(audit_table_ref)
@@ -130,100 +464,316 @@ def apply_masking_from_config(**kwargs):
         table = bigquery.Table(audit_table_ref, schema=schema)
         bq_client.create_table(table)
         print(f"Tabla de auditoría creada: {audit_table_ref}")
+    return audit_table_ref
+
+def build_shards(table_refs):
+    if SHARD_POR == "dataset":
+        grupos = {}
+        for table_ref in sorted(table_refs):
+            grupos.setdefault(table_ref.rsplit(".", 1)[0], []).append(table_ref)
+        return list(grupos.items())
+    table_refs = sorted(table_refs)
+    return [
+        (f"tablas_{i // SHARD_TABLAS:04d}", table_refs[i:i + SHARD_TABLAS])
+        for i in range(0, len(table_refs), SHARD_TABLAS)
+    ]
+
+def plan_masking_shards(**kwargs):
+    bq_client = bigquery.Client(project=PROJECT_ID)
+    datacatalog_client = datacatalog_v1.PolicyTagManagerClient()
+
+    ensure_audit_table(bq_client)
+    reglas = read_masking_rules(bq_client)
+    taxonomy_name = get_or_create_taxonomy(datacatalog_client)
+    policy_tags = load_policy_tag_registry(datacatalog_client, taxonomy_name)
+
+    # Los policy tags se crean acá y no en los shards, así dos shards nunca compiten por crear el mismo tag
+    pendientes = {
+        r["policy_tag_display_name"]: r["description"]
+        for r in reglas.values() if r["policy_tag_display_name"] not in policy_tags
+    }
+    run_concurrently(
+        lambda item: get_or_create_policy_tag(datacatalog_client, taxonomy_name, policy_tags, item[0], item[1]),
+        pendientes.items(),
+    )
+    save_policy_tag_registry(datacatalog_client, taxonomy_name, policy_tags)
 
-    # Leer configuraciones de la tabla masking_policies
+    shards = build_shards({f"{p}.{d}.{t}" for (p, d, t, _) in reglas})
+    print(f"Reglas: {len(reglas)}. Policy Tags creados: {len(pendientes)}. Shards: {len(shards)}")
+    return [{"shard_id": shard_id, "tablas": tablas, "taxonomy_name": taxonomy_name} for shard_id, tablas in shards]
+
+def read_shard_rules(bq_client, tablas):
     query = f"""
     SELECT project_id, dataset_id, table_id, column_name, restricted_users
     FROM `{PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}`
+    WHERE CONCAT(project_id, '.', dataset_id, '.', table_id) IN UNNEST(@tablas)
     """
-    rows = bq_client.query(query).result()
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ArrayQueryParameter("tablas", "STRING", tablas)])
+    reglas_por_tabla = {}
+    for row in bq_client.query(query, job_config=job_config).result():
+        reglas_por_tabla.setdefault(f"{row.project_id}.{row.dataset_id}.{row.table_id}", []).append(row)
+    return reglas_por_tabla
 
-    parent = f"projects/{PROJECT_ID}/locations/{LOCATION}"
+def apply_masking_shard(shard_id, tablas, taxonomy_name, **kwargs):
+    bq_client = bigquery.Client(project=PROJECT_ID)
+    datacatalog_client = datacatalog_v1.PolicyTagManagerClient()
 
-    # Reutilizar o crear taxonomía
-    taxonomy_name = None
-    for taxonomy in datacatalog_client.list_taxonomies(parent=parent):
-        if taxonomy.display_name == "Masking":
-            taxonomy_name = taxonomy.name
-            print(f"Taxonomía 'Masking' existente reutilizada: {taxonomy_name}")
-            break
-
-    if not taxonomy_name:
-        taxonomy = datacatalog_v1.Taxonomy(
-            display_name="Masking",
-            activated_policy_types=[datacatalog_v1.Taxonomy.PolicyType.FINE_GRAINED_ACCESS_CONTROL],
-        )
-        taxonomy = datacatalog_client.create_taxonomy(parent=parent, taxonomy=taxonomy)
-        taxonomy_name = taxonomy.name
-        print(f"Creada nueva taxonomía: {taxonomy_name}")
-
-    # Aplicar políticas
-    for row in rows:
-        project_id, dataset_id, table_id, column_name = row.project_id, row.dataset_id, row.table_id, row.column_name
-        restricted_users = [u.strip() for u in row.restricted_users.split(",")]
-        policy_tag_display_name = f"{table_id}_{column_name}_mask"
-
-        # Crear o reutilizar policy tag
-        existing_tags = list(datacatalog_client.list_policy_tags(parent=taxonomy_name))
-        existing = next((t for t in existing_tags if t.display_name == policy_tag_display_name), None)
-        if existing:
-            policy_tag_name = existing.name
-            print(f"Policy Tag existente reutilizado: {policy_tag_name}")
-        else:
-            policy_tag = datacatalog_v1.PolicyTag(
-                display_name=policy_tag_display_name,
-                description=f"Oculta columna {column_name} en {table_id}",
-            )
-            policy_tag_obj = datacatalog_client.create_policy_tag(parent=taxonomy_name, policy_tag=policy_tag)
-            policy_tag_name = policy_tag_obj.name
-            print(f"Policy Tag creado: {policy_tag_name}")
+    policy_tags = load_policy_tag_registry(datacatalog_client, taxonomy_name)
+    reglas_por_tabla = read_shard_rules(bq_client, tablas)
 
-        # Aplicar en tabla
-        table_ref = f"{project_id}.{dataset_id}.{table_id}"
-        table = bq_client.get_table(table_ref)
-        new_schema = []
-        for field in table.schema:
-            if field.name == column_name:
-                field = bigquery.SchemaField(
-                    field.name, field.field_type, mode=field.mode,
-                    policy_tags=bigquery.PolicyTagList(names=[policy_tag_name]),
-                )
-            new_schema.append(field)
-        table.schema = new_schema
-        bq_client.update_table(table, ["schema"])
-        print(f"Policy Tag aplicado en {table_ref}.{column_name}")
-
-        # Revocar acceso
-        policy = datacatalog_client.get_iam_policy(request={"resource": policy_tag_name})
-        new_policy = policy_pb2.Policy()
-        for binding in policy.bindings:
-            allowed_members = [m for m in binding.members if m not in [f"user:{u}" for u in restricted_users]]
-            if allowed_members:
-                new_binding = new_policy.bindings.add()
-                new_binding.role = binding.role
-                new_binding.members.extend(allowed_members)
-        datacatalog_client.set_iam_policy(request={"resource": policy_tag_name, "policy": new_policy})
-        print(f"Acceso restringido a {restricted_users}")
+    # Aplicar en tabla: tablas en paralelo, un único get_table y a lo sumo un update_table por tabla.
+    # Un reintento del shard no vuelve a escribir las tablas que ya quedaron con los tags correctos.
+    def aplicar_tabla(item):
+        table_ref, table_rows = item
+        try:
+            table = call_api("bigquery", bq_client.get_table, table_ref)
+            actuales = leaf_policy_tags(table)
+            cambios = {}
+            for row in table_rows:
+                display_name, _ = policy_tag_for_rule(row.table_id, row.column_name, parse_restricted_users(row.restricted_users))
+                cambios[row.column_name] = policy_tags[display_name]
+            # Solo los campos hoja aceptan tags: una regla sobre un RECORD o un campo inexistente no queda pendiente
+            pendientes = {c: tag for c, tag in cambios.items() if c in actuales and actuales[c] != tag}
+            if pendientes:
+                rewrite_table_schema(bq_client, table_ref, pendientes, table=table)
+                print(f"Policy Tags aplicados en {table_ref}: {', '.join(pendientes)}")
+            else:
+                print(f"Policy Tags ya aplicados en {table_ref}, se omite")
+        except Exception as e:
+            print(f"Error al aplicar Policy Tags en {table_ref}: {e}")
+            return table_ref, None
 
         # Registrar auditoría
-        audit_row = [{
-            "timestamp": datetime.utcnow().isoformat(),
-            "taxonomy_name": taxonomy_name,
-            "policy_tag_name": policy_tag_name,
-            "project_id": project_id,
-            "dataset_id": dataset_id,
-            "table_id": table_id,
-            "column_name": column_name,
-            "restricted_users": ",".join(restricted_users),
-        }]
-        errors = bq_client.insert_rows_json(audit_table_ref, audit_row)
-        if errors:
-            print(f"Error al insertar auditoría: {errors}")
+        return table_ref, [
+            audit_row(
+                taxonomy_name, cambios[row.column_name], row.project_id, row.dataset_id,
+                row.table_id, row.column_name, parse_restricted_users(row.restricted_users),
+            )
+            for row in table_rows
+        ]
+
+    auditoria, fallidas = [], []
+    for table_ref, filas in run_concurrently(aplicar_tabla, reglas_por_tabla.items()):
+        if filas is None:
+            fallidas.append(table_ref)
         else:
-            print(f"Auditoría registrada para {table_id}.{column_name}")
+            auditoria.extend(filas)
 
+    # Las tablas que fallaron hacen fallar solo este shard; el reintento saltea las que ya se aplicaron
+    if fallidas:
+        raise RuntimeError(f"Shard {shard_id}: fallaron {len(fallidas)} tablas: {', '.join(fallidas)}")
+    print(f"Shard {shard_id}: {len(reglas_por_tabla)} tablas, {len(auditoria)} filas de auditoría")
+    return auditoria
+
+def write_shard_audit(bq_client, ti, task_id):
+    # Escribe en una sola pasada las filas de auditoría devueltas (XCom) por las tareas mapeadas de task_id
+    audit_table_ref = f"{PROJECT_ID}.{BQ_DATASET}.{BQ_AUDIT_TABLE}"
+    resultados = ti.xcom_pull(task_ids=task_id) or []
+    with AuditWriter(bq_client, audit_table_ref) as auditoria:
+        for filas in resultados:
+            auditoria.extend(filas or [])
+    print(f"Shards consolidados: {len(resultados)}. Filas de auditoría: {auditoria.filas_escritas}")
+
+def merge_audit_results(**kwargs):
+    bq_client = bigquery.Client(project=PROJECT_ID)
+    write_shard_audit(bq_client, kwargs["ti"], "Aplica_masking")
     print("Aplicación de políticas y auditoría completadas.")
 
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Revocar accesos (se ejecuta como tarea separada, luego de asociar todos los policy tags):
+
+def restrict_access_from_config(**kwargs):
+    bq_client = bigquery.Client(project=PROJECT_ID)
+    datacatalog_client = datacatalog_v1.PolicyTagManagerClient()
+
+    reglas = read_masking_rules(bq_client)
+    taxonomy_name = get_or_create_taxonomy(datacatalog_client)
+    policy_tags = load_policy_tag_registry(datacatalog_client, taxonomy_name)
+    restricciones = build_restrictions(reglas, policy_tags)
+
+    actualizadas = apply_iam_policies(datacatalog_client, restricciones)
+    print(f"Políticas IAM actualizadas: {actualizadas} de {len(restricciones)} policy tags")
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Reconciliación incremental (MODO_EJECUCION = "reconcile"):
+# Lee el estado actual (taxonomía, policy tags, columnas con tag e IAM), lo compara contra las reglas
+# y ejecuta solo las llamadas necesarias. Una corrida sin cambios no realiza llamadas de escritura.
+# Se reparte en shards igual que el modo "full":
+# 1. Planifica_reconciliacion lee el estado, calcula el diff, crea los policy tags faltantes y reparte las tablas a
+#    modificar en shards (build_shards), cada uno con sus cambios planificados.
+# 2. Reconcilia_masking se expande en una tarea por shard; cada una solo reescribe las columnas que todavía no tienen
+#    el tag planificado, así un reintento no repite escrituras y audita las mismas columnas.
+# 3. Finaliza_reconciliacion consolida la auditoría, revoca accesos y elimina los policy tags sin reglas. No se
+#    ejecuta si falló algún shard: las columnas de ese shard todavía pueden apuntar a los tags a eliminar.
+
+def read_current_state(bq_client, datacatalog_client, taxonomy_name, reglas):
+    tags = load_policy_tag_registry(datacatalog_client, taxonomy_name)
+
+    # Se inspeccionan las tablas de las reglas y las que tienen policy tags dentro de CLEAR_SCOPES
+    # (mismo alcance que clear_existing_policies), sin leer las tablas que no tienen tags
+    table_refs = {f"{p}.{d}.{t}" for (p, d, t, _) in reglas}
+    table_refs |= set(discover_tagged_columns(bq_client))
+
+    def leer_tabla(table_ref):
+        try:
+            return table_ref, call_api("bigquery", bq_client.get_table, table_ref)
+        except NotFound:
+            print(f"Tabla inexistente, se omite: {table_ref}")
+            return table_ref, None
+
+    tablas = {}
+    columnas_con_tag = {}
+    campos_por_tabla = {}
+    for table_ref, table in run_concurrently(leer_tabla, sorted(table_refs)):
+        if table is None:
+            continue
+        tablas[table_ref] = table
+        hojas = leaf_policy_tags(table)
+        campos_por_tabla[table_ref] = set(hojas)
+        for ruta, policy_tag_name in hojas.items():
+            # Solo se administran los policy tags de la taxonomía del proceso
+            if policy_tag_name and policy_tag_name.startswith(f"{taxonomy_name}/"):
+                columnas_con_tag[(table_ref, ruta)] = policy_tag_name
+
+    return {"tags": tags, "tablas": tablas, "columnas_con_tag": columnas_con_tag, "campos": campos_por_tabla}
+
+def compute_reconcile_diff(reglas, estado):
+    tags_deseados = {r["policy_tag_display_name"] for r in reglas.values()}
+    diff = {
+        "crear_tags": sorted(tags_deseados - set(estado["tags"])),
+        "eliminar_tags": sorted(set(estado["tags"]) - tags_deseados),
+        "cambios_por_tabla": {},
+    }
+
+    columnas_deseadas = set()
+    for (project_id, dataset_id, table_id, column_name), regla in reglas.items():
+        table_ref = f"{project_id}.{dataset_id}.{table_id}"
+        if table_ref not in estado["tablas"]:
+            continue
+        if column_name not in estado["campos"][table_ref]:
+            # Campo inexistente o RECORD: no se puede taggear y reescribir la tabla en cada corrida no lo cambiaría
+            print(f"Columna inexistente o RECORD, se omite: {table_ref}.{column_name}")
+            continue
+        columnas_deseadas.add((table_ref, column_name))
+        tag_actual = estado["columnas_con_tag"].get((table_ref, column_name))
+        if tag_actual is None or tag_actual != estado["tags"].get(regla["policy_tag_display_name"]):
+            diff["cambios_por_tabla"].setdefault(table_ref, {})[column_name] = regla["policy_tag_display_name"]
+
+    # Columnas con un tag de la taxonomía que ya no figuran en las reglas: se les quita el tag
+    for (table_ref, column_name) in estado["columnas_con_tag"]:
+        if (table_ref, column_name) not in columnas_deseadas:
+            diff["cambios_por_tabla"].setdefault(table_ref, {})[column_name] = None
+
+    return diff
+
+def plan_reconcile_shards(**kwargs):
+    bq_client = bigquery.Client(project=PROJECT_ID)
+    datacatalog_client = datacatalog_v1.PolicyTagManagerClient()
+
+    ensure_audit_table(bq_client)
+    reglas = read_masking_rules(bq_client)
+    taxonomy_name = get_or_create_taxonomy(datacatalog_client)
+    estado = read_current_state(bq_client, datacatalog_client, taxonomy_name, reglas)
+    diff = compute_reconcile_diff(reglas, estado)
+    tags = estado["tags"]
+    descripciones = {r["policy_tag_display_name"]: r["description"] for r in reglas.values()}
+
+    # Los policy tags se crean acá y no en los shards, así dos shards nunca compiten por crear el mismo tag
+    run_concurrently(
+        lambda display_name: get_or_create_policy_tag(datacatalog_client, taxonomy_name, tags, display_name, descripciones[display_name]),
+        diff["crear_tags"],
+    )
+    save_policy_tag_registry(datacatalog_client, taxonomy_name, tags)
+
+    # Los tags a eliminar se calculan con el mismo estado que los cambios de schema y se eliminan al final
+    kwargs["ti"].xcom_push(key="eliminar_tags", value=diff["eliminar_tags"])
+
+    shards = build_shards(diff["cambios_por_tabla"])
+    print(
+        f"Reglas: {len(reglas)}. Policy Tags creados: {len(diff['crear_tags'])}. "
+        f"Tablas a modificar: {len(diff['cambios_por_tabla'])}. Shards: {len(shards)}"
+    )
+    return [
+        {"shard_id": shard_id, "cambios": {t: diff["cambios_por_tabla"][t] for t in tablas}, "taxonomy_name": taxonomy_name}
+        for shard_id, tablas in shards
+    ]
+
+def apply_reconcile_shard(shard_id, cambios, taxonomy_name, **kwargs):
+    bq_client = bigquery.Client(project=PROJECT_ID)
+    datacatalog_client = datacatalog_v1.PolicyTagManagerClient()
+
+    policy_tags = load_policy_tag_registry(datacatalog_client, taxonomy_name)
+    reglas_por_tabla = read_shard_rules(bq_client, sorted(cambios))
+
+    # cambios: tabla -> columna -> display name del tag planificado (None lo quita). Tablas en paralelo, un único
+    # get_table y a lo sumo un update_table por tabla. Solo se auditan las columnas a las que se les aplica un tag.
+    def aplicar_tabla(item):
+        table_ref, cambios_tabla = item
+        deseados = {c: policy_tags[d] if d else None for c, d in cambios_tabla.items()}
+        try:
+            table = call_api("bigquery", bq_client.get_table, table_ref)
+            actuales = leaf_policy_tags(table)
+            pendientes = {c: tag for c, tag in deseados.items() if c in actuales and actuales[c] != tag}
+            if pendientes:
+                rewrite_table_schema(bq_client, table_ref, pendientes, table=table)
+                print(f"Schema actualizado en {table_ref}: {len(pendientes)} columnas")
+            else:
+                print(f"Schema ya actualizado en {table_ref}, se omite")
+        except Exception as e:
+            print(f"Error al actualizar el schema de {table_ref}: {e}")
+            return table_ref, None
+
+        project_id, dataset_id, table_id = table_ref.split(".")
+        usuarios = {row.column_name: parse_restricted_users(row.restricted_users) for row in reglas_por_tabla.get(table_ref, [])}
+        return table_ref, [
+            audit_row(taxonomy_name, deseados[column_name], project_id, dataset_id, table_id, column_name, usuarios[column_name])
+            for column_name, display_name in cambios_tabla.items() if display_name and column_name in usuarios
+        ]
+
+    auditoria, fallidas = [], []
+    for table_ref, filas in run_concurrently(aplicar_tabla, sorted(cambios.items())):
+        if filas is None:
+            fallidas.append(table_ref)
+        else:
+            auditoria.extend(filas)
+
+    # Las tablas que fallaron hacen fallar solo este shard; el reintento saltea las que ya se actualizaron
+    if fallidas:
+        raise RuntimeError(f"Shard {shard_id}: fallaron {len(fallidas)} tablas: {', '.join(fallidas)}")
+    print(f"Shard {shard_id}: {len(cambios)} tablas, {len(auditoria)} filas de auditoría")
+    return auditoria
+
+def finish_reconcile(**kwargs):
+    bq_client = bigquery.Client(project=PROJECT_ID)
+    datacatalog_client = datacatalog_v1.PolicyTagManagerClient()
+
+    write_shard_audit(bq_client, kwargs["ti"], "Reconcilia_masking")
+
+    reglas = read_masking_rules(bq_client)
+    taxonomy_name = get_or_create_taxonomy(datacatalog_client)
+    tags = load_policy_tag_registry(datacatalog_client, taxonomy_name)
+
+    # Revocar acceso solo donde las bindings actuales incluyen usuarios restringidos
+    mutaciones = apply_iam_policies(datacatalog_client, build_restrictions(reglas, tags))
+
+    # Eliminar los policy tags que ya no se usan (ya desasociados por los shards)
+    eliminar_tags = kwargs["ti"].xcom_pull(task_ids="Planifica_reconciliacion", key="eliminar_tags") or []
+
+    def eliminar_tag(item):
+        display_name, policy_tag_name = item
+        try:
+            call_api("policy_tag", datacatalog_client.delete_policy_tag, name=policy_tag_name)
+        except NotFound:
+            pass
+        print(f"Policy Tag eliminado: {display_name}")
+
+    eliminar = [(d, tags.pop(d)) for d in eliminar_tags if d in tags]
+    run_concurrently(eliminar_tag, eliminar)
+    mutaciones += len(eliminar)
+
+    save_policy_tag_registry(datacatalog_client, taxonomy_name, tags)
+    print(f"Reconciliación completada. Llamadas de escritura (IAM y eliminación de tags): {mutaciones}")
+
 # ---------------------------------------------------------------------------------------------------------------------------------
 # DAG:
 
@@ -238,7 +788,35 @@ with DAG(
 
     Lectura_Sheet = PythonOperator(task_id="Lectura_Sheet", python_callable=extract_sheet_from_gcs)
     Sheet_a_GCP = PythonOperator(task_id="Sheet_a_GCP", python_callable=load_config_to_bq)
-    Limpieza_politicas_existentes = PythonOperator(task_id="Limpieza_politicas_existentes", python_callable=clear_existing_policies)
-    Aplica_masking = PythonOperator(task_id="Aplica_masking", python_callable=apply_masking_from_config)
 
-    Lectura_Sheet >> Sheet_a_GCP >> Limpieza_politicas_existentes >> Aplica_masking
+    if MODO_EJECUCION == "reconcile":
+        Planifica_reconciliacion = PythonOperator(task_id="Planifica_reconciliacion", python_callable=plan_reconcile_shards)
+        Reconcilia_masking = PythonOperator.partial(
+            task_id="Reconcilia_masking",
+            python_callable=apply_reconcile_shard,
+            retries=SHARD_RETRIES,
+            retry_delay=timedelta(minutes=1),
+            max_active_tis_per_dag=SHARD_MAX_PARALELOS,
+        ).expand(op_kwargs=Planifica_reconciliacion.output)
+        # none_failed: sin tablas a modificar no hay shards (la tarea mapeada queda skipped) y aun así se revocan accesos
+        Finaliza_reconciliacion = PythonOperator(
+            task_id="Finaliza_reconciliacion", python_callable=finish_reconcile, trigger_rule="none_failed",
+        )
+
+        Lectura_Sheet >> Sheet_a_GCP >> Planifica_reconciliacion
+        Reconcilia_masking >> Finaliza_reconciliacion
+    else:
+        Limpieza_politicas_existentes = PythonOperator(task_id="Limpieza_politicas_existentes", python_callable=clear_existing_policies)
+        Planifica_masking = PythonOperator(task_id="Planifica_masking", python_callable=plan_masking_shards)
+        Aplica_masking = PythonOperator.partial(
+            task_id="Aplica_masking",
+            python_callable=apply_masking_shard,
+            retries=SHARD_RETRIES,
+            retry_delay=timedelta(minutes=1),
+            max_active_tis_per_dag=SHARD_MAX_PARALELOS,
+        ).expand(op_kwargs=Planifica_masking.output)
+        Consolida_auditoria = PythonOperator(task_id="Consolida_auditoria", python_callable=merge_audit_results)
+        Restringe_accesos = PythonOperator(task_id="Restringe_accesos", python_callable=restrict_access_from_config)
+
+        Lectura_Sheet >> Sheet_a_GCP >> Limpieza_politicas_existentes >> Planifica_masking
+        Aplica_masking >> Consolida_auditoria >> Restringe_accesos
@@ -0,0 +1,187 @@
+# -------------------------------------------------------------------------------------------------------------------
+# Benchmark del pipeline de Masking contra el backend falso de fake_backend.py (sin proyecto de GCP).
+# Genera reglas sintéticas (N columnas repartidas en tablas de --columnas-por-tabla columnas), las sube al bucket
+# falso y ejecuta las etapas de main.py en orden, reportando por etapa: tiempo de pared, llamadas por método de API
+# y pico de memoria (tracemalloc, que agrega overhead al tiempo de CPU):
+#
+#   python benchmarks/bench_pipeline.py --columnas 100 10000 100000 --latencia-ms 50 --workers 8
+#   python benchmarks/bench_pipeline.py --columnas 1000 --latencia-metodo bigquery.update_table=300 --json out.json
+#   python benchmarks/bench_pipeline.py --columnas 10000 --destinos 4 --latencia-ms 50
+#
+# Por defecto los token buckets de main.py se reemplazan por límites muy altos para medir solo el pipeline;
+# --con-limites usa API_RATE_LIMITS tal como están configurados.
+# Requiere las dependencias de requirements.txt instaladas (se usan los tipos reales del SDK).
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main as pipeline
+from fake_backend import FakeBackend
+from google.cloud import bigquery
+
+PROJECT_ID = "bench-project"
+BQ_DATASET = "bench_dataset"
+COLUMNAS_SIN_MASKING = 5
+USUARIOS = [f"usuario{i}@example.com" for i in range(50)]
+
+def destino(k):
+    # Destinos sintéticos: un proyecto por destino, alternando las multi-regiones US y EU
+    return (PROJECT_ID if k == 0 else f"{PROJECT_ID}-{k}"), ("US" if k % 2 == 0 else "EU")
+
+def generar_reglas(columnas, columnas_por_tabla, grupos_usuarios, destinos=1, seed=0):
+    # Devuelve el CSV de reglas y el schema de cada tabla sintética. Las tablas se reparten entre los destinos y los
+    # restricted_users de cada columna salen de un conjunto acotado de grupos, como en las reglas reales
+    rnd = random.Random(seed)
+    grupos = [",".join(rnd.sample(USUARIOS, rnd.randint(1, 3))) for _ in range(grupos_usuarios)]
+    filas, schemas = [], {}
+    for i in range(columnas):
+        tabla = i // columnas_por_tabla
+        project_id, _ = destino(tabla % destinos)
+        table_id = f"tabla_{tabla:05d}"
+        column_name = f"col_{i % columnas_por_tabla:03d}"
+        restringidos = rnd.choice(grupos)
+        filas.append((project_id, BQ_DATASET, table_id, column_name, restringidos))
+        schemas.setdefault(f"{project_id}.{BQ_DATASET}.{table_id}", [
+            bigquery.SchemaField(f"libre_{j}", "STRING") for j in range(COLUMNAS_SIN_MASKING)
+        ]).append(bigquery.SchemaField(column_name, "STRING"))
+
+    csv_reglas = io.StringIO()
+    csv_reglas.write(",".join(pipeline.CONFIG_COLUMNS) + "\n")
+    for fila in filas:
+        csv_reglas.write(",".join(f'"{valor}"' for valor in fila) + "\n")
+    return csv_reglas.getvalue(), schemas
+
+def preparar(args, columnas):
+    # Todos los usuarios arrancan como lectores de cada tag, así la etapa de IAM tiene accesos para revocar
+    backend = FakeBackend(
+        args.latencia_ms / 1000,
+        {metodo: ms / 1000 for metodo, ms in args.latencia_metodo},
+        miembros_iniciales=[f"user:{u}" for u in USUARIOS],
+    )
+    csv_reglas, schemas = generar_reglas(columnas, args.columnas_por_tabla, args.grupos_usuarios, args.destinos)
+    backend.storage.upload(pipeline.BUCKET_NAME.replace("gs://", ""), pipeline.SHEET_PATH, csv_reglas)
+    for k in range(args.destinos):
+        project_id, location = destino(k)
+        backend.bigquery.add_dataset(f"{project_id}.{BQ_DATASET}", location)
+    for table_ref, schema in schemas.items():
+        backend.bigquery.add_table(table_ref, schema)
+
+    pipeline.PROJECT_ID = PROJECT_ID
+    pipeline.BQ_DATASET = BQ_DATASET
+    pipeline.CLEAR_SCOPES = [f"{PROJECT_ID}.{BQ_DATASET}"]
+    pipeline.POLICY_TAG_CACHE_PATH = ""
+    pipeline.MAX_WORKERS = args.workers
+    pipeline.ESQUEMA_POLICY_TAGS = args.esquema_policy_tags
+    pipeline.TABLE_LOCKS.clear()
+    pipeline.DATASET_LOCATIONS.clear()
+    pipeline.DATASETS_INEXISTENTES.clear()
+    pipeline.TAXONOMY_CACHE.clear()
+    if args.con_limites:
+        rates = pipeline.API_RATE_LIMITS
+    else:
+        rates = {family: 1e9 for family in pipeline.API_RATE_LIMITS}
+    pipeline.RATE_LIMITERS.update({family: pipeline.TokenBucket(rate) for family, rate in rates.items()})
+    backend.install(pipeline)
+    return backend, len(schemas)
+
+def etapa_ingesta():
+    datos, fuente = pipeline.extract_sheet_from_gcs()
+    pipeline.load_config_to_bq(datos)
+    pipeline.record_config_source(fuente)
+
+def etapa_evento():
+    # Cambia los restricted_users del 1% de las reglas, sube una nueva generación del CSV y procesa el evento de GCS
+    bucket = pipeline.get_storage_client().bucket(pipeline.BUCKET_NAME.replace("gs://", ""))
+    encabezado, *filas = bucket.objetos[pipeline.SHEET_PATH][0].splitlines()
+    for i in range(0, len(filas), 100):
+        valores = filas[i].split('","')
+        valores[-1] = f'{USUARIOS[i % len(USUARIOS)]}"'
+        filas[i] = '","'.join(valores)
+    generation = bucket.guardar(pipeline.SHEET_PATH, "\n".join([encabezado, *filas]) + "\n")
+    blob = bucket.get_blob(pipeline.SHEET_PATH)
+    pipeline.main_gcs_event({"bucket": bucket.name, "name": pipeline.SHEET_PATH, "generation": generation, "md5Hash": blob.md5_hash}, None)
+
+ETAPAS = [
+    ("ingesta", etapa_ingesta),
+    ("clear (sin tags)", pipeline.clear_existing_policies),
+    ("apply", pipeline.apply_masking_from_config),
+    ("reconcile (IAM)", pipeline.reconcile_masking_policies),
+    ("reconcile (sin cambios)", pipeline.reconcile_masking_policies),
+    ("main (CSV sin cambios)", lambda: pipeline.main(None)),
+    ("evento GCS (1% de reglas)", etapa_evento),
+    ("reconcile (post evento)", pipeline.reconcile_masking_policies),
+    ("clear (con tags)", pipeline.clear_existing_policies),
+]
+
+def medir_etapas(backend):
+    resultados = []
+    with open(os.devnull, "w") as devnull:
+        for nombre, etapa in ETAPAS:
+            backend.recorder.reset()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            inicio = time.perf_counter()
+            with contextlib.redirect_stdout(devnull):
+                etapa()
+            duracion = time.perf_counter() - inicio
+            pico = tracemalloc.get_traced_memory()[1] - base
+            resultados.append({
+                "etapa": nombre,
+                "segundos": round(duracion, 3),
+                "pico_mb": round(pico / 1024 / 1024, 2),
+                "llamadas": dict(sorted(backend.recorder.llamadas.items())),
+            })
+    return resultados
+
+def imprimir(columnas, tablas, resultados):
+    print(f"\n=== {columnas} columnas en {tablas} tablas ===")
+    print(f"{'etapa':<26}{'tiempo (s)':>12}{'llamadas':>10}{'pico (MB)':>11}")
+    for r in resultados:
+        print(f"{r['etapa']:<26}{r['segundos']:>12.3f}{sum(r['llamadas'].values()):>10}{r['pico_mb']:>11.2f}")
+        for metodo, cantidad in r["llamadas"].items():
+            print(f"    {metodo:<40}{cantidad:>10}")
+
+def latencia_metodo(valor):
+    metodo, ms = valor.split("=")
+    return metodo, float(ms)
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide tiempo, llamadas a APIs y memoria por etapa con un backend falso.")
+    parser.add_argument("--columnas", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--columnas-por-tabla", type=int, default=20)
+    parser.add_argument("--grupos-usuarios", type=int, default=30, help="Conjuntos distintos de restricted_users.")
+    parser.add_argument("--destinos", type=int, default=1, help="Proyectos (alternando US y EU) entre los que se reparten las tablas.")
+    parser.add_argument("--workers", type=int, default=pipeline.MAX_WORKERS)
+    parser.add_argument("--latencia-ms", type=float, default=0, help="Latencia simulada por llamada (ms).")
+    parser.add_argument("--latencia-metodo", type=latencia_metodo, action="append", default=[],
+                        help="Latencia de un método puntual, ej. bigquery.update_table=300 (ms).")
+    parser.add_argument("--esquema-policy-tags", choices=["columna", "usuarios"], default=pipeline.ESQUEMA_POLICY_TAGS,
+                        help="Un policy tag por columna o por conjunto de restricted_users.")
+    parser.add_argument("--con-limites", action="store_true", help="Respeta API_RATE_LIMITS de main.py.")
+    parser.add_argument("--json", help="Archivo donde guardar los resultados en JSON.")
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    reporte = []
+    for columnas in args.columnas:
+        backend, tablas = preparar(args, columnas)
+        resultados = medir_etapas(backend)
+        imprimir(columnas, tablas, resultados)
+        reporte.append({"columnas": columnas, "tablas": tablas, "etapas": resultados})
+    tracemalloc.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"parametros": vars(args), "resultados": reporte}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# -------------------------------------------------------------------------------------------------------------------
+# Medición del cold start de la Cloud Function: tiempo de import de main.py y pico de memoria (RSS) del proceso.
+# Cada medición corre en un proceso nuevo, igual que una instancia fría. Compara el main.py actual contra el de una
+# revisión de git (por defecto HEAD, es decir, antes de los cambios sin commitear):
+#
+#   python benchmarks/cold_start.py --ref <revision> --repeticiones 10
+#   python benchmarks/cold_start.py --ref <revision> --python-ref /ruta/venv_ref/bin/python
+#
+# Requiere las dependencias de requirements.txt instaladas (y pandas/flask si la revisión de referencia las importa).
+# google-cloud-bigquery importa pandas si está instalado, así que para comparar revisiones con distintos requirements.txt
+# conviene medir cada una en su propio entorno: --python-ref es el intérprete de un venv con los de la referencia.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPET = """
+import resource, time
+inicio = time.perf_counter()
+import main
+duracion = time.perf_counter() - inicio
+print(duracion, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+def medir(directorio, repeticiones, python=sys.executable):
+    tiempos, picos_rss = [], []
+    for _ in range(repeticiones):
+        salida = subprocess.run(
+            [python, "-c", SNIPPET], cwd=directorio, capture_output=True, text=True, check=True,
+        ).stdout.split()
+        tiempos.append(float(salida[0]))
+        picos_rss.append(int(salida[1]))
+    return statistics.median(tiempos), max(picos_rss)
+
+def main_desde_revision(ref, directorio):
+    fuente = subprocess.run(
+        ["git", "show", f"{ref}:main.py"], cwd=REPO_DIR, capture_output=True, check=True,
+    ).stdout
+    with open(os.path.join(directorio, "main.py"), "wb") as f:
+        f.write(fuente)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara import time y pico de RSS de main.py entre dos versiones.")
+    parser.add_argument("--ref", default="HEAD", help="Revisión de git usada como 'antes' (default: HEAD).")
+    parser.add_argument("--repeticiones", type=int, default=10)
+    parser.add_argument("--python-ref", default=sys.executable, help="Intérprete con el que se mide la revisión de referencia.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directorio:
+        main_desde_revision(args.ref, directorio)
+        antes = medir(directorio, args.repeticiones, args.python_ref)
+    despues = medir(REPO_DIR, args.repeticiones)
+
+    print(f"{'':<10}{'import (ms)':>14}{'pico RSS (MB)':>16}")
+    for nombre, (duracion, rss_kb) in ((f"{args.ref}", antes), ("actual", despues)):
+        print(f"{nombre:<10}{duracion * 1000:>14.1f}{rss_kb / 1024:>16.1f}")
+    print(f"{'delta':<10}{(despues[0] - antes[0]) * 1000:>+14.1f}{(despues[1] - antes[1]) / 1024:>+16.1f}")
+
+if __name__ == "__main__":
+    main()
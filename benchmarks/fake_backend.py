@@ -0,0 +1,381 @@
+# -------------------------------------------------------------------------------------------------------------------
+# Backend falso en memoria para medir el pipeline sin un proyecto de GCP.
+# Reemplaza a los clientes de Cloud Storage, BigQuery y Data Catalog que usa main.py: cada llamada queda registrada
+# (servicio.método) y puede demorarse una latencia configurable para simular los round trips de red.
+# Los tipos (SchemaField, Table, Policy) son los del SDK real, por lo que requiere requirements.txt instalado.
+import base64
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from google.api_core.exceptions import Aborted, AlreadyExists, NotFound
+from google.cloud import bigquery
+from google.iam.v1 import policy_pb2
+
+class CallRecorder:
+    def __init__(self, latencia=0.0, latencia_por_metodo=None):
+        self.latencia = latencia
+        self.latencia_por_metodo = latencia_por_metodo or {}
+        self.llamadas = Counter()
+        self.lock = threading.Lock()
+
+    def registrar(self, metodo):
+        with self.lock:
+            self.llamadas[metodo] += 1
+        espera = self.latencia_por_metodo.get(metodo, self.latencia)
+        if espera:
+            time.sleep(espera)
+
+    def reset(self):
+        with self.lock:
+            self.llamadas.clear()
+
+# -------------------------------------------------------------------------------------------------------------------
+# Cloud Storage
+class FakeBlob:
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+
+    def _objeto(self):
+        # Con generation se lee esa versión del objeto (bucket con versionado), si todavía existe
+        if self.generation is not None:
+            if (self.name, int(self.generation)) not in self.bucket.versiones:
+                raise NotFound(f"No existe gs://{self.bucket.name}/{self.name}#{self.generation}")
+            return self.bucket.versiones[(self.name, int(self.generation))], int(self.generation)
+        return self.bucket.objetos[self.name]
+
+    @property
+    def md5_hash(self):
+        contenido, _ = self._objeto()
+        return base64.b64encode(hashlib.md5(contenido.encode("utf-8")).digest()).decode()
+
+    crc32c = None
+
+    def download_as_text(self):
+        self.bucket.recorder.registrar("storage.download_as_text")
+        return self._objeto()[0]
+
+    def open(self, mode="rt", encoding="utf-8"):
+        self.bucket.recorder.registrar("storage.open")
+        # Se decodifica con el encoding pedido, como en GCS: con "utf-8-sig" se descarta el BOM
+        return io.TextIOWrapper(io.BytesIO(self._objeto()[0].encode("utf-8")), encoding=encoding)
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket.recorder.registrar("storage.upload_from_string")
+        self.bucket.guardar(self.name, data)
+
+    def delete(self):
+        self.bucket.recorder.registrar("storage.delete")
+        if self.bucket.objetos.pop(self.name, None) is None:
+            raise NotFound(f"No existe gs://{self.bucket.name}/{self.name}")
+
+class FakeBucket:
+    def __init__(self, name, recorder):
+        self.name = name
+        self.recorder = recorder
+        self.objetos = {}
+        self.versiones = {}
+        self.generacion = 0
+
+    def guardar(self, name, contenido):
+        # Las generaciones son únicas en el bucket, como en GCS; las versiones anteriores quedan en versiones
+        self.generacion += 1
+        self.objetos[name] = (contenido, self.generacion)
+        self.versiones[(name, self.generacion)] = contenido
+        return self.generacion
+
+    def get_blob(self, name):
+        self.recorder.registrar("storage.get_blob")
+        if name not in self.objetos:
+            return None
+        return FakeBlob(self, name, self.objetos[name][1])
+
+    def blob(self, name, generation=None):
+        return FakeBlob(self, name, generation)
+
+class FakeStorageClient:
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.buckets = {}
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, FakeBucket(name, self.recorder))
+
+    def upload(self, bucket_name, path, contenido):
+        return self.bucket(bucket_name).guardar(path, contenido)
+
+# -------------------------------------------------------------------------------------------------------------------
+# BigQuery
+class FakeJob:
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+
+    def result(self):
+        return iter(self.rows)
+
+class FakeBigQueryClient:
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.tablas = {}
+        self.datos = {}
+        self.ubicaciones = {}
+        self.lock = threading.Lock()
+        self.ultimo_batch_id = 0
+
+    @staticmethod
+    def _ref(table):
+        if isinstance(table, str):
+            return table
+        return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+    @staticmethod
+    def _copia(table):
+        return bigquery.Table.from_api_repr(json.loads(json.dumps(table.to_api_repr())))
+
+    def _guardar(self, ref, table):
+        # Cada escritura cambia el etag de la tabla, como en BigQuery
+        copia = self._copia(table)
+        anterior = self.tablas.get(ref)
+        copia._properties["etag"] = str(int((anterior.etag if anterior is not None else None) or 0) + 1)
+        self.tablas[ref] = copia
+
+    def add_dataset(self, dataset_ref, location="US"):
+        with self.lock:
+            self.ubicaciones[dataset_ref] = location
+
+    def add_table(self, table_ref, schema):
+        with self.lock:
+            self.ubicaciones.setdefault(table_ref.rsplit(".", 1)[0], "US")
+            self._guardar(table_ref, bigquery.Table(table_ref, schema=schema))
+
+    def get_dataset(self, dataset_ref):
+        self.recorder.registrar("bigquery.get_dataset")
+        with self.lock:
+            if dataset_ref not in self.ubicaciones:
+                raise NotFound(f"Not found: Dataset {dataset_ref}")
+            return SimpleNamespace(dataset_id=dataset_ref.split(".")[1], location=self.ubicaciones[dataset_ref])
+
+    def get_table(self, table):
+        self.recorder.registrar("bigquery.get_table")
+        ref = self._ref(table)
+        with self.lock:
+            if ref not in self.tablas:
+                raise NotFound(f"Not found: Table {ref}")
+            return self._copia(self.tablas[ref])
+
+    def update_table(self, table, fields):
+        self.recorder.registrar("bigquery.update_table")
+        ref = self._ref(table)
+        with self.lock:
+            if table.etag and self.tablas[ref].etag != table.etag:
+                raise Aborted(f"Etag mismatch: {ref}")
+            self._guardar(ref, table)
+        return table
+
+    def create_table(self, table):
+        self.recorder.registrar("bigquery.create_table")
+        with self.lock:
+            self._guardar(self._ref(table), table)
+        return table
+
+    def list_tables(self, dataset):
+        self.recorder.registrar("bigquery.list_tables")
+        prefijo = f"{dataset}."
+        with self.lock:
+            return [
+                SimpleNamespace(table_id=ref[len(prefijo):])
+                for ref in self.tablas if ref.startswith(prefijo)
+            ]
+
+    def insert_rows_json(self, table, rows):
+        self.recorder.registrar("bigquery.insert_rows_json")
+        with self.lock:
+            self.datos.setdefault(self._ref(table), []).extend(rows)
+        return []
+
+    def load_table_from_json(self, rows, table, job_config=None):
+        self.recorder.registrar("bigquery.load_table_from_json")
+        self._cargar(self._ref(table), list(rows), job_config)
+        return FakeJob()
+
+    def load_table_from_file(self, file_obj, table, job_config=None):
+        self.recorder.registrar("bigquery.load_table_from_file")
+        rows = [json.loads(linea) for linea in file_obj.read().decode("utf-8").splitlines() if linea]
+        self._cargar(self._ref(table), rows, job_config)
+        return FakeJob()
+
+    def _cargar(self, ref, rows, job_config):
+        with self.lock:
+            if ref not in self.tablas:
+                self.tablas[ref] = bigquery.Table(ref, schema=job_config.schema if job_config else None)
+            if job_config is not None and job_config.write_disposition == "WRITE_TRUNCATE":
+                self.datos[ref] = []
+            self.datos.setdefault(ref, []).extend(rows)
+
+    def query(self, sql, location=None):
+        self.recorder.registrar("bigquery.query")
+        if "INFORMATION_SCHEMA.COLUMN_FIELD_PATHS" in sql:
+            scopes = re.findall(r"`([^`]+)\.INFORMATION_SCHEMA", sql)
+            with self.lock:
+                # Como en BigQuery, un dataset inexistente hace fallar toda la consulta
+                for scope in scopes:
+                    if ".region-" not in scope and scope not in self.ubicaciones:
+                        raise NotFound(f"Not found: Dataset {scope}")
+            return FakeJob(self._columnas_con_tags(scopes))
+        if "DECLARE next_id" in sql:
+            with self.lock:
+                self.ultimo_batch_id += 1
+                return FakeJob([SimpleNamespace(batch_id=self.ultimo_batch_id)])
+        if sql.lstrip().upper().startswith("INSERT"):
+            return FakeJob()
+        origen = re.search(r"FROM\s+`([^`]+)`", sql)
+        with self.lock:
+            rows = list(self.datos.get(origen.group(1), [])) if origen else []
+        return FakeJob(SimpleNamespace(**row) for row in rows)
+
+    def _columnas_con_tags(self, scopes):
+        rows = []
+        with self.lock:
+            tablas = list(self.tablas.items())
+        for ref, table in tablas:
+            project, dataset, table_id = ref.split(".")
+            region = f"{project}.region-{self.ubicaciones.get(f'{project}.{dataset}', 'US').lower()}"
+            if not any(ref.startswith(f"{scope}.") or scope.lower() == region for scope in scopes):
+                continue
+            for column_name, field_path, policy_tags in self._rutas_con_tags(table.schema):
+                rows.append(SimpleNamespace(
+                    table_catalog=project, table_schema=dataset, table_name=table_id,
+                    column_name=column_name, field_path=field_path, policy_tags=policy_tags,
+                ))
+        return rows
+
+    def _rutas_con_tags(self, campos, prefijo="", columna=None):
+        # Como COLUMN_FIELD_PATHS: una fila por campo (también los anidados) con la columna de primer nivel
+        for field in campos:
+            ruta = f"{prefijo}{field.name}"
+            if field.policy_tags is not None and field.policy_tags.names:
+                yield columna or field.name, ruta, list(field.policy_tags.names)
+            yield from self._rutas_con_tags(field.fields, f"{ruta}.", columna or field.name)
+
+# -------------------------------------------------------------------------------------------------------------------
+# Data Catalog (PolicyTagManagerClient)
+class FakeDataCatalogClient:
+    def __init__(self, recorder, miembros_iniciales=()):
+        # miembros_iniciales: lectores (categoryFineGrainedReader) que tiene cada policy tag al crearse
+        self.recorder = recorder
+        self.miembros_iniciales = list(miembros_iniciales)
+        self.taxonomias = {}
+        self.policy_tags = {}
+        self.por_display_name = {}
+        self.politicas = {}
+        self.lock = threading.Lock()
+        self.secuencia = 0
+
+    def _nuevo_id(self):
+        self.secuencia += 1
+        return self.secuencia
+
+    def _eliminar_tag(self, name):
+        policy_tag = self.policy_tags.pop(name)
+        self.por_display_name.pop((name.split("/policyTags/")[0], policy_tag.display_name), None)
+        self.politicas.pop(name, None)
+
+    def _tocar(self, taxonomy_name):
+        self.taxonomias[taxonomy_name].taxonomy_timestamps.update_time = datetime.now(timezone.utc)
+
+    def list_taxonomies(self, parent):
+        self.recorder.registrar("datacatalog.list_taxonomies")
+        with self.lock:
+            return [t for name, t in self.taxonomias.items() if name.startswith(f"{parent}/")]
+
+    def get_taxonomy(self, name):
+        self.recorder.registrar("datacatalog.get_taxonomy")
+        with self.lock:
+            if name not in self.taxonomias:
+                raise NotFound(name)
+            return self.taxonomias[name]
+
+    def create_taxonomy(self, parent, taxonomy):
+        self.recorder.registrar("datacatalog.create_taxonomy")
+        with self.lock:
+            name = f"{parent}/taxonomies/{self._nuevo_id()}"
+            self.taxonomias[name] = SimpleNamespace(
+                name=name,
+                display_name=taxonomy.display_name,
+                taxonomy_timestamps=SimpleNamespace(update_time=datetime.now(timezone.utc)),
+            )
+            return self.taxonomias[name]
+
+    def delete_taxonomy(self, name):
+        self.recorder.registrar("datacatalog.delete_taxonomy")
+        with self.lock:
+            self.taxonomias.pop(name)
+            for tag_name in [n for n in self.policy_tags if n.startswith(f"{name}/")]:
+                self._eliminar_tag(tag_name)
+
+    def list_policy_tags(self, parent):
+        self.recorder.registrar("datacatalog.list_policy_tags")
+        with self.lock:
+            return [t for name, t in self.policy_tags.items() if name.startswith(f"{parent}/")]
+
+    def create_policy_tag(self, parent, policy_tag):
+        self.recorder.registrar("datacatalog.create_policy_tag")
+        with self.lock:
+            if (parent, policy_tag.display_name) in self.por_display_name:
+                raise AlreadyExists(policy_tag.display_name)
+            name = f"{parent}/policyTags/{self._nuevo_id()}"
+            self.policy_tags[name] = SimpleNamespace(name=name, display_name=policy_tag.display_name)
+            self.por_display_name[(parent, policy_tag.display_name)] = name
+            self._tocar(parent)
+            return self.policy_tags[name]
+
+    def delete_policy_tag(self, name):
+        self.recorder.registrar("datacatalog.delete_policy_tag")
+        with self.lock:
+            self._eliminar_tag(name)
+            self._tocar(name.split("/policyTags/")[0])
+
+    def get_iam_policy(self, request):
+        self.recorder.registrar("datacatalog.get_iam_policy")
+        with self.lock:
+            policy = policy_pb2.Policy()
+            if request["resource"] in self.politicas:
+                policy.CopyFrom(self.politicas[request["resource"]])
+            else:
+                policy.etag = b"0"
+                if self.miembros_iniciales:
+                    policy.bindings.add(role="roles/datacatalog.categoryFineGrainedReader", members=self.miembros_iniciales)
+            return policy
+
+    def set_iam_policy(self, request):
+        self.recorder.registrar("datacatalog.set_iam_policy")
+        with self.lock:
+            # Como en IAM, una política leída antes de otra escritura (etag distinto) se rechaza
+            actual = self.politicas[request["resource"]].etag if request["resource"] in self.politicas else b"0"
+            if request["policy"].etag and request["policy"].etag != actual:
+                raise Aborted(f"Etag mismatch: {request['resource']}")
+            policy = policy_pb2.Policy()
+            policy.CopyFrom(request["policy"])
+            policy.etag = str(int(policy.etag or b"0") + 1).encode()
+            self.politicas[request["resource"]] = policy
+            return policy
+
+class FakeBackend:
+    def __init__(self, latencia=0.0, latencia_por_metodo=None, miembros_iniciales=()):
+        self.recorder = CallRecorder(latencia, latencia_por_metodo)
+        self.storage = FakeStorageClient(self.recorder)
+        self.bigquery = FakeBigQueryClient(self.recorder)
+        self.datacatalog = FakeDataCatalogClient(self.recorder, miembros_iniciales)
+
+    def install(self, modulo):
+        # Reemplaza el pool de clientes de main.py por los clientes falsos
+        modulo.CLIENTS.clear()
+        modulo.CLIENTS.update(storage=self.storage, bigquery=self.bigquery, datacatalog=self.datacatalog)
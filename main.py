@@ -1,126 +1,664 @@
-from google.cloud import storage, bigquery, datacatalog_v1
-from google.api_core.exceptions import NotFound
+from google.cloud import bigquery, datacatalog_v1
+from google.api_core.exceptions import NotFound, AlreadyExists, Aborted, TooManyRequests, ResourceExhausted
 from google.iam.v1 import policy_pb2
-from datetime import datetime
-import pandas as pd
-import io
-import flask
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import base64
+import csv
+import functools
+import hashlib
+import importlib
+import io
+import json
+import os
+import threading
 import time
 
 # -------------------------------------------------------------------------------------------------------------------
 # Parámetros globales
 PROJECT_ID = "test-1-426619"         #Completar: ID del proyecto.
-LOCATION = "us"                      #Completar: Zona de ubicación del proyecto.
+LOCATION = "us"                      #Completar: Zona de ubicación del proyecto (dataset de reglas/auditoría).
 BUCKET_NAME = "archivos_rls"        #Completar: Nombre del bucket de Cloud Storage.
 SHEET_PATH = "masking_policies.csv"  #Completar: Nombre del archivo CSV.
 BQ_DATASET = "test_RLS"              #Completar: Dataset en donde se alocara la tabla de auditoria.
 BQ_TABLE = "masking_reglas"          #Completar: Nombre de la tabla que contendra las reglas de Masking en Bigquery.
 BQ_AUDIT_TABLE = "masking_auditoria" #Completar: Nombre de la tabla de auditoría en BigQuery.
+BQ_RUNS_TABLE = "masking_ejecuciones" #Completar: Nombre de la tabla con la metadata de cada corrida (origen del batch_id).
+OMITIR_SI_SIN_CAMBIOS = True         #Completar: Si el CSV no cambió desde la última corrida exitosa, se omiten la carga y la aplicación.
+MODO_EJECUCION = "reconcile"         #Completar: "reconcile" (aplica solo las diferencias) o "full" (elimina y recrea todas las politicas).
+TAXONOMY_DISPLAY_NAME = "Masking"    #Nombre de la taxonomía administrada por el proceso.
+POLICY_TAG_CACHE_PATH = "/tmp/masking_policy_tags.json"  #Opcional: cache local de policy tags entre corridas ("" para deshabilitar).
+MAX_WORKERS = 8                      #Completar: Cantidad de llamadas concurrentes a las APIs (1 = ejecución secuencial).
+API_RATE_LIMITS = {                  #Completar: Llamadas por segundo permitidas por familia de API.
+    "bigquery": 10,                  # get_table / update_table
+    "policy_tag": 5,                 # list / create / delete de taxonomías y policy tags
+    "iam": 10,                       # get_iam_policy / set_iam_policy
+}
+API_MAX_RETRIES = 5                  #Reintentos ante errores de cuota (429) con backoff exponencial.
+CLEAR_SCOPES = [f"{PROJECT_ID}.{BQ_DATASET}"] #Completar: Datasets ("proyecto.dataset") o regiones ("proyecto.region-us") donde se buscan columnas con policy tags, además de los datasets de las reglas.
+AUDIT_CHUNK_ROWS = 500               #Máximo de filas de auditoría por insert_rows_json.
+AUDIT_CHUNK_BYTES = 5 * 1024 * 1024  #Máximo de bytes por insert_rows_json (la API admite hasta 10 MB por request).
+AUDIT_LOAD_JOB_MIN_ROWS = 10000      #Los lotes de auditoría de este tamaño o mayores se escriben con un load job.
+CHECKPOINT_PATH = "masking_checkpoint.json" #Completar: Objeto en BUCKET_NAME donde se guarda el progreso de una corrida incompleta.
+TIEMPO_LIMITE_SEG = 480              #Completar: Segundos de trabajo por invocación; debe quedar por debajo del --timeout (540s).
+CHECKPOINT_CADA_TABLAS = 50          #Cada cuántas tablas aplicadas se guarda el checkpoint durante la aplicación.
+ESQUEMA_POLICY_TAGS = "columna"      #Completar: "columna" (un policy tag por columna) o "usuarios" (un policy tag por conjunto de restricted_users).
+METRICS_EXPORT_HOOK = ""             #Opcional: "modulo.funcion" que recibe el resumen de cada corrida (dict) para exportar las métricas.
+EVENTO_REINTENTO_MAX_SEG = 3600      #Completar: Antigüedad máxima (s) de un evento de GCS que se sigue reintentando (requiere --retry).
+PLAN_PATH = "masking_plan.json"      #Completar: Objeto en BUCKET_NAME donde se guarda el plan (?accion=plan) que ejecuta ?accion=apply.
+PLAN_CHECKPOINT_PATH = "masking_plan_checkpoint.json" #Completar: Objeto en BUCKET_NAME donde se guarda el progreso de un ?accion=apply incompleto.
+PLAN_LATENCIA_MS = {                 #Latencia estimada por llamada (ms) de los métodos que el plan no llega a observar.
+    "bigquery": 1000,
+    "policy_tag": 300,
+    "iam": 200,
+}
 
 
 # -------------------------------------------------------------------------------------------------------------------
-# Creacion/actualizacion de la tabla que contiene las reglas de Masking en BigQuery     
-def extract_sheet_from_gcs():
-    client = storage.Client()
-    bucket = client.bucket(BUCKET_NAME.replace("gs://", ""))
-    blob = bucket.blob(SHEET_PATH)
-    content = blob.download_as_text()
-    df = pd.read_csv(io.StringIO(content))
-    print(f"Archivo leído correctamente. Filas: {len(df)}")
-    df.to_csv("/tmp/masking_policies.csv", index=False)
-
-def load_config_to_bq():
-    client = bigquery.Client(project=PROJECT_ID)
-    table_ref = f"{PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}"
+# Pool de clientes: cada cliente se crea una única vez por instancia (a demanda) y se reutiliza entre etapas y entre
+# invocaciones en caliente. storage se importa recién al usarse, ya que solo lo necesita la lectura del CSV.
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+def get_client(name, factory):
+    client = CLIENTS.get(name)
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(name)
+            if client is None:
+                client = CLIENTS[name] = factory()
+    return client
+
+def get_bq_client():
+    return get_client("bigquery", lambda: bigquery.Client(project=PROJECT_ID))
+
+def get_datacatalog_client():
+    return get_client("datacatalog", datacatalog_v1.PolicyTagManagerClient)
+
+def get_storage_client():
+    def factory():
+        from google.cloud import storage
+        return storage.Client()
+    return get_client("storage", factory)
+
+# -------------------------------------------------------------------------------------------------------------------
+# Instrumentación: duración de cada etapa, y por cada método de API llamadas, errores, reintentos e histograma de
+# latencias, más contadores de filas procesadas. Cada etapa y el resumen final se emiten como logs JSON estructurados
+# (Cloud Logging los indexa como jsonPayload) y main() devuelve el resumen de la corrida.
+HISTOGRAM_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class RunMetrics:
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.etapas = {}
+        self.api = {}
+        self.contadores = {}
+        self.lock = threading.Lock()
+
+    def record_stage(self, nombre, duracion, estado):
+        with self.lock:
+            etapa = self.etapas.setdefault(nombre, {"ejecuciones": 0, "duracion_s": 0.0})
+            etapa["ejecuciones"] += 1
+            etapa["duracion_s"] += duracion
+            etapa["estado"] = estado
+
+    def _api(self, nombre):
+        return self.api.setdefault(nombre, {
+            "llamadas": 0, "errores": 0, "reintentos": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "histograma_ms": {f"<={limite}": 0 for limite in HISTOGRAM_BUCKETS_MS} | {"+Inf": 0},
+        })
+
+    def record_api(self, nombre, duracion, error):
+        ms = duracion * 1000
+        bucket = next((f"<={limite}" for limite in HISTOGRAM_BUCKETS_MS if ms <= limite), "+Inf")
+        with self.lock:
+            api = self._api(nombre)
+            api["llamadas"] += 1
+            api["errores"] += int(error)
+            api["total_ms"] += ms
+            api["max_ms"] = max(api["max_ms"], ms)
+            api["histograma_ms"][bucket] += 1
+
+    def record_retry(self, nombre):
+        with self.lock:
+            self._api(nombre)["reintentos"] += 1
 
-    auditoria = []
-    batch_id = 1
+    def mean_latency_ms(self, nombre):
+        # Latencia media observada de un método, o None si no se llamó en esta corrida
+        with self.lock:
+            api = self.api.get(nombre)
+            return api["total_ms"] / api["llamadas"] if api and api["llamadas"] else None
+
+    def count(self, nombre, cantidad=1):
+        with self.lock:
+            self.contadores[nombre] = self.contadores.get(nombre, 0) + cantidad
+
+    def summary(self):
+        with self.lock:
+            llamadas = sum(api["llamadas"] for api in self.api.values())
+            errores = sum(api["errores"] for api in self.api.values())
+            return {
+                "duracion_s": round(time.perf_counter() - self.inicio, 3),
+                "etapas": {nombre: {**etapa, "duracion_s": round(etapa["duracion_s"], 3)} for nombre, etapa in self.etapas.items()},
+                "api": {
+                    nombre: {**api, "total_ms": round(api["total_ms"], 1), "max_ms": round(api["max_ms"], 1)}
+                    for nombre, api in sorted(self.api.items())
+                },
+                "llamadas_api": llamadas,
+                "tasa_error_api": round(errores / llamadas, 4) if llamadas else 0.0,
+                "contadores": dict(self.contadores),
+            }
+
+METRICS = RunMetrics()
+
+def reset_metrics():
+    global METRICS
+    METRICS = RunMetrics()
+
+def log_event(evento, severity="INFO", **campos):
+    print(json.dumps({"severity": severity, "evento": evento, **campos}, default=str, ensure_ascii=False))
+
+def timed_call(nombre, fn, *args, **kwargs):
+    inicio = time.perf_counter()
+    error = False
     try:
-        result = client.query(f"SELECT COALESCE(MAX(batch_id), 0) AS max_batch FROM `{table_ref}`").to_dataframe()
-        batch_id = int(result["max_batch"].iloc[0]) + 1
+        return fn(*args, **kwargs)
+    except NotFound:
+        # Es la respuesta esperada de los chequeos de existencia (tablas de auditoría, corridas, etc.)
+        raise
     except Exception:
+        error = True
+        raise
+    finally:
+        METRICS.record_api(nombre, time.perf_counter() - inicio, error)
+
+def timed_stage(nombre):
+    def decorador(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            inicio = time.perf_counter()
+            estado = "error"
+            try:
+                resultado = fn(*args, **kwargs)
+                estado = "ok"
+                return resultado
+            except TimeBudgetExceeded:
+                estado = "incompleta"
+                raise
+            finally:
+                duracion = time.perf_counter() - inicio
+                METRICS.record_stage(nombre, duracion, estado)
+                log_event("etapa", etapa=nombre, estado=estado, duracion_s=round(duracion, 3))
+        return wrapper
+    return decorador
+
+def export_metrics(resumen):
+    # El hook no puede hacer fallar la corrida: los errores se registran y se continúa
+    if not METRICS_EXPORT_HOOK:
+        return
+    try:
+        modulo, funcion = METRICS_EXPORT_HOOK.rsplit(".", 1)
+        getattr(importlib.import_module(modulo), funcion)(resumen)
+    except Exception as e:
+        log_event("export_metricas", severity="WARNING", error=str(e))
+
+# -------------------------------------------------------------------------------------------------------------------
+# Ejecución concurrente con control de cuota: un token bucket por familia de API y un pool de hilos
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                espera = (1 - self.tokens) / self.rate
+            time.sleep(espera)
+
+RATE_LIMITERS = {family: TokenBucket(rate) for family, rate in API_RATE_LIMITS.items()}
+TABLE_LOCKS = {}
+TABLE_LOCKS_GUARD = threading.Lock()
+
+def list_all(method, **kwargs):
+    # Recorre todas las páginas dentro de call_api, así el rate limit y los reintentos cubren también la paginación
+    return list(method(**kwargs))
+
+def call_api(family, fn, *args, **kwargs):
+    nombre = f"{family}.{(args[0] if fn is list_all else fn).__name__}"
+    for intento in range(API_MAX_RETRIES + 1):
+        RATE_LIMITERS[family].acquire()
+        try:
+            return timed_call(nombre, fn, *args, **kwargs)
+        except (TooManyRequests, ResourceExhausted) as e:
+            if intento == API_MAX_RETRIES:
+                raise
+            espera = min(2 ** intento, 32)
+            METRICS.record_retry(nombre)
+            print(f"Cuota excedida en {family}, reintento en {espera}s: {e}")
+            time.sleep(espera)
+
+def table_lock(table_ref):
+    # Las escrituras sobre una misma tabla se serializan para que los updates de schema no se pisen
+    with TABLE_LOCKS_GUARD:
+        return TABLE_LOCKS.setdefault(table_ref, threading.RLock())
+
+def run_concurrently(fn, items):
+    items = list(items)
+    if MAX_WORKERS <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(fn, items))
+
+# -------------------------------------------------------------------------------------------------------------------
+# Escritura de auditoría con buffer: inserta en bloques acotados por filas y bytes, usa un load job para lotes
+# grandes y, usado como context manager, escribe lo acumulado aunque la corrida falle a mitad de camino
+class AuditWriter:
+    def __init__(self, bq_client, table_ref):
+        self.bq_client = bq_client
+        self.table_ref = table_ref
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.filas_escritas = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        return False
+
+    def extend(self, rows):
+        with self.lock:
+            for row in rows:
+                self.buffer.append(row)
+                self.buffer_bytes += len(json.dumps(row))
+            if len(self.buffer) >= AUDIT_CHUNK_ROWS or self.buffer_bytes >= AUDIT_CHUNK_BYTES:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        rows, self.buffer, self.buffer_bytes = self.buffer, [], 0
+        if not rows:
+            return
+        if len(rows) >= AUDIT_LOAD_JOB_MIN_ROWS:
+            job_config = bigquery.LoadJobConfig(
+                schema=timed_call("bigquery.get_table", self.bq_client.get_table, self.table_ref).schema,
+                write_disposition="WRITE_APPEND",
+            )
+            job = timed_call("bigquery.load_table_from_json", self.bq_client.load_table_from_json, rows, self.table_ref, job_config=job_config)
+            timed_call("bigquery.load_job", job.result)
+        else:
+            for chunk in self._chunks(rows):
+                errors = timed_call("bigquery.insert_rows_json", self.bq_client.insert_rows_json, self.table_ref, chunk)
+                if errors:
+                    print(f"Error al insertar auditoría: {errors}")
+        self.filas_escritas += len(rows)
+        METRICS.count("filas_auditoria", len(rows))
+
+    def _chunks(self, rows):
+        chunk, chunk_bytes = [], 0
+        for row in rows:
+            row_bytes = len(json.dumps(row))
+            if chunk and (len(chunk) >= AUDIT_CHUNK_ROWS or chunk_bytes + row_bytes > AUDIT_CHUNK_BYTES):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(row)
+            chunk_bytes += row_bytes
+        if chunk:
+            yield chunk
+
+# -------------------------------------------------------------------------------------------------------------------
+# Checkpoint y presupuesto de tiempo: cada invocación trabaja como máximo TIEMPO_LIMITE_SEG y, si no termina, deja en
+# GCS el progreso (etapa, batch_id, tablas completadas, tags con IAM verificado) para que la siguiente invocación continúe.
+PLAZO_EJECUCION = None
+
+class TimeBudgetExceeded(Exception):
+    pass
+
+def start_time_budget():
+    global PLAZO_EJECUCION
+    PLAZO_EJECUCION = time.monotonic() + TIEMPO_LIMITE_SEG
+
+def time_budget_exceeded():
+    # Fuera de main() (DAG, benchmarks) no hay plazo
+    return PLAZO_EJECUCION is not None and time.monotonic() >= PLAZO_EJECUCION
+
+def checkpoint_path(modo=None):
+    # La aplicación de un plan guarda su progreso aparte, así una corrida de main() no lo pisa ni lo toma como propio
+    return PLAN_CHECKPOINT_PATH if modo == "plan" else CHECKPOINT_PATH
+
+def checkpoint_blob(modo=None):
+    return get_storage_client().bucket(BUCKET_NAME.replace("gs://", "")).blob(checkpoint_path(modo))
+
+def read_checkpoint(modo=None):
+    blob = timed_call("storage.get_blob", get_storage_client().bucket(BUCKET_NAME.replace("gs://", "")).get_blob, checkpoint_path(modo))
+    if blob is None:
+        return None
+    try:
+        return json.loads(timed_call("storage.download_as_text", blob.download_as_text))
+    except ValueError as e:
+        print(f"Checkpoint ilegible, se ignora: {e}")
+        return None
+
+def save_checkpoint(checkpoint):
+    checkpoint["actualizado"] = datetime.utcnow().isoformat()
+    timed_call("storage.upload_from_string", checkpoint_blob(checkpoint.get("modo")).upload_from_string, json.dumps(checkpoint), content_type="application/json")
+
+def delete_checkpoint(modo=None):
+    try:
+        timed_call("storage.delete", checkpoint_blob(modo).delete)
+    except NotFound:
         pass
 
+# -------------------------------------------------------------------------------------------------------------------
+# Creacion/actualizacion de la tabla que contiene las reglas de Masking en BigQuery     
+CONFIG_COLUMNS = ["project_id", "dataset_id", "table_id", "column_name", "restricted_users"]
+
+def read_config_source():
+    # Generación y checksum del CSV, y configuración con la que se aplicó (ESQUEMA_POLICY_TAGS, MODO_EJECUCION),
+    # registrados en los labels de la tabla de reglas en la última corrida exitosa
+    try:
+        labels = timed_call("bigquery.get_table", get_bq_client().get_table, f"{PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}").labels
+    except NotFound:
+        return None
+    return {
+        "generation": labels.get("source_generation"),
+        "checksum": labels.get("source_checksum"),
+        "esquema": labels.get("source_esquema"),
+        "modo": labels.get("source_modo"),
+    }
+
+def config_changed(anterior):
+    # True si la última corrida exitosa se aplicó con otro esquema de policy tags u otro modo: el CSV puede no haber
+    # cambiado, pero el estado de las políticas sí tiene que cambiar (por ejemplo, la migración a tags por usuarios)
+    return (anterior["esquema"], anterior["modo"]) != (ESQUEMA_POLICY_TAGS, MODO_EJECUCION)
+
+def record_config_source(fuente):
+    # Se llama al finalizar la aplicación: si la corrida falla, la próxima vuelve a procesar el mismo archivo
+    client = get_bq_client()
+    table = timed_call("bigquery.get_table", client.get_table, f"{PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}")
+    table.labels = {
+        **table.labels,
+        "source_generation": fuente["generation"],
+        "source_checksum": fuente["checksum"],
+        "source_esquema": ESQUEMA_POLICY_TAGS,
+        "source_modo": MODO_EJECUCION,
+    }
+    timed_call("bigquery.update_table", client.update_table, table, ["labels"])
+
+def normalize_config_row(row):
+    # Devuelve la fila normalizada o None si no tiene los campos obligatorios
+    fila = {column: (row.get(column) or "").strip() for column in CONFIG_COLUMNS}
+    if not all(fila[column] for column in CONFIG_COLUMNS[:4]):
+        return None
+    fila["restricted_users"] = ",".join(parse_restricted_users(fila["restricted_users"]))
+    return fila
+
+def read_sheet_metadata():
+    # Metadata del CSV (sin descargarlo) y su identificación: generación y checksum
+    client = get_storage_client()
+    bucket = client.bucket(BUCKET_NAME.replace("gs://", ""))
+    metadata = timed_call("storage.get_blob", bucket.get_blob, SHEET_PATH)
+    if metadata is None:
+        raise NotFound(f"No existe gs://{bucket.name}/{SHEET_PATH}")
+    return metadata, source_from_object(metadata.generation, metadata.md5_hash, metadata.crc32c)
+
+def source_from_object(generation, md5_hash, crc32c):
+    # Identificación de una generación del CSV a partir de la metadata del objeto (blob o evento de GCS)
+    return {"generation": str(generation), "checksum": base64.b64decode(md5_hash or crc32c).hex()}
+
+def read_rules_csv(blob, ndjson=None):
+    # Reglas normalizadas del CSV, leídas en streaming, y filas descartadas (incompletas o con la clave repetida: vale la
+    # primera). Sin ndjson devuelve las filas por (proyecto, dataset, tabla, columna), que necesita el cálculo del delta;
+    # con ndjson cada fila se escribe directamente en ese stream (el del load job) y solo se devuelven las claves.
+    # utf-8-sig y los encabezados sin espacios aceptan los CSV exportados desde Excel o Sheets.
+    filas, claves, descartadas = {}, set(), 0
+    with blob.open("rt", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        reader.fieldnames = [(column or "").strip() for column in reader.fieldnames or []]
+        faltantes = set(CONFIG_COLUMNS) - set(reader.fieldnames)
+        if faltantes:
+            raise ValueError(f"Faltan columnas en {SHEET_PATH}: {sorted(faltantes)}")
+        for row in reader:
+            fila = normalize_config_row(row)
+            clave = fila and (fila["project_id"], fila["dataset_id"], fila["table_id"], fila["column_name"])
+            if fila is None or clave in claves:
+                descartadas += 1
+                continue
+            claves.add(clave)
+            if ndjson is None:
+                filas[clave] = fila
+            else:
+                ndjson.write(json.dumps(fila).encode("utf-8") + b"\n")
+    return (filas if ndjson is None else claves), descartadas
+
+def rules_to_ndjson(filas):
+    datos = io.BytesIO()
+    for fila in filas.values():
+        datos.write(json.dumps(fila).encode("utf-8") + b"\n")
+    datos.seek(0)
+    return datos
+
+@timed_stage("lectura_csv")
+def extract_sheet_from_gcs():
+    # Lee el CSV en streaming, valida y normaliza cada fila y la deja en memoria como NDJSON listo para el load job
+    # (sin copias intermedias en /tmp). Devuelve None si el archivo no cambió desde la última corrida exitosa y esa
+    # corrida usó la misma configuración.
+    metadata, fuente = read_sheet_metadata()
+    anterior = read_config_source() if OMITIR_SI_SIN_CAMBIOS else None
+    if anterior and anterior["checksum"] == fuente["checksum"]:
+        if not config_changed(anterior):
+            print(f"Sin cambios en {SHEET_PATH} (generación {anterior['generation']} -> {fuente['generation']})")
+            return None
+        print(
+            f"{SHEET_PATH} sin cambios, pero la última corrida usó ESQUEMA_POLICY_TAGS={anterior['esquema']} y "
+            f"MODO_EJECUCION={anterior['modo']}: se vuelven a aplicar las reglas"
+        )
+
+    datos = io.BytesIO()
+    claves, descartadas = read_rules_csv(metadata.bucket.blob(SHEET_PATH, generation=metadata.generation), datos)
+    datos.seek(0)
+    METRICS.count("filas_csv", len(claves))
+    METRICS.count("filas_descartadas", descartadas)
+    print(f"Archivo leído correctamente. Filas: {len(claves)}. Descartadas: {descartadas}")
+    return datos, fuente
+
+@timed_stage("carga_reglas")
+def load_config_to_bq(datos):
+    client = get_bq_client()
+    table_ref = f"{PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}"
+
     job_config = bigquery.LoadJobConfig(
-        source_format=bigquery.SourceFormat.CSV,
-        skip_leading_rows=1,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
         write_disposition="WRITE_TRUNCATE",
-        schema=[
-            bigquery.SchemaField("project_id", "STRING"),
-            bigquery.SchemaField("dataset_id", "STRING"),
-            bigquery.SchemaField("table_id", "STRING"),
-            bigquery.SchemaField("column_name", "STRING"),
-            bigquery.SchemaField("restricted_users", "STRING"),
-        ],
+        schema=[bigquery.SchemaField(column, "STRING") for column in CONFIG_COLUMNS],
     )
 
-    with open("/tmp/masking_policies.csv", "rb") as f:
-        job = client.load_table_from_file(f, table_ref, job_config=job_config)
-        job.result()
+    job = timed_call("bigquery.load_table_from_file", client.load_table_from_file, datos, table_ref, job_config=job_config)
+    timed_call("bigquery.load_job", job.result)
 
     print(f"Configuración cargada exitosamente en {table_ref}")
 
 # -------------------------------------------------------------------------------------------------------------------
 # Eliminacion de las reglas de Masking pre existentes  
+@timed_stage("limpieza")
 def clear_existing_policies():
-    bq_client = bigquery.Client(project=PROJECT_ID)
-    datacatalog_client = datacatalog_v1.PolicyTagManagerClient()
+    bq_client = get_bq_client()
+    datacatalog_client = get_datacatalog_client()
 
     print("🧹 Eliminando Policy Tags previos...")
-    tables = list(bq_client.list_tables(f"{PROJECT_ID}.{BQ_DATASET}"))
-    for table_item in tables:
-        table_ref = f"{PROJECT_ID}.{BQ_DATASET}.{table_item.table_id}"
-        table = bq_client.get_table(table_ref)
-        new_schema = []
-        modified = False
-
-        for field in table.schema:
-            if getattr(field, "policy_tags", None) and field.policy_tags.names:
-                print(f"Removiendo policy tag de {field.name} en {table_ref}")
-                clean_field = bigquery.SchemaField(
-                    name=field.name,
-                    field_type=field.field_type,
-                    mode=field.mode,
-                    description=field.description,
-                    fields=field.fields,
-                )
-                new_schema.append(clean_field)
-                modified = True
-            else:
-                new_schema.append(field)
 
-        if modified:
-            table.schema = new_schema
-            bq_client.update_table(table, ["schema"])
+    # Se inspeccionan CLEAR_SCOPES y los datasets de las reglas, en todos sus proyectos y ubicaciones. Solo se leen y
+    # reescriben las tablas que INFORMATION_SCHEMA reporta con policy tags de la taxonomía del proceso (de cualquiera
+    # de los destinos, ya que todas se eliminan al final): los tags de otras taxonomías no se tocan.
+    scopes_por_destino = target_scopes(bq_client, resolve_targets(bq_client, rule_datasets(bq_client)))
+    gestionadas = run_concurrently(lambda d: get_or_create_taxonomy(datacatalog_client, *d, crear=False), scopes_por_destino)
+    prefijos = tuple(f"{taxonomy_name}/" for taxonomy_name in gestionadas if taxonomy_name)
+    tablas_con_tags = {}
+    if prefijos:
+        columnas = discover_tagged_columns(bq_client, [s for scopes in scopes_por_destino.values() for s in scopes])
+        for table_ref, campos in columnas.items():
+            propias = {ruta for ruta, policy_tags in campos.items() if any(t.startswith(prefijos) for t in policy_tags)}
+            if propias:
+                tablas_con_tags[table_ref] = propias
+    print(f"Tablas con policy tags del proceso: {len(tablas_con_tags)}")
+
+    def limpiar_tabla(item):
+        table_ref, columnas = item
+        if time_budget_exceeded():
+            return False
+        for column_name in sorted(columnas):
+            print(f"Removiendo policy tag de {column_name} en {table_ref}")
+        rewrite_table_schema(bq_client, table_ref, {column_name: None for column_name in columnas})
+        return True
+
+    # Sin tiempo para todas las tablas no se borran las taxonomías: la siguiente invocación vuelve a descubrir
+    # solo las tablas que todavía tienen tags
+    pendientes = run_concurrently(limpiar_tabla, tablas_con_tags.items()).count(False)
+    if pendientes:
+        raise TimeBudgetExceeded(f"Limpieza incompleta: quedan {pendientes} tablas con policy tags")
 
     print("🧹 Eliminando taxonomías anteriores...")
-    parent = f"projects/{PROJECT_ID}/locations/{LOCATION}"
-    for taxonomy in datacatalog_client.list_taxonomies(parent=parent):
+
+    def listar_taxonomias(destino):
+        parent = f"projects/{destino[0]}/locations/{destino[1]}"
+        return call_api("policy_tag", list_all, datacatalog_client.list_taxonomies, parent=parent)
+
+    def eliminar_taxonomia(taxonomy):
         try:
-            datacatalog_client.delete_taxonomy(name=taxonomy.name)
+            call_api("policy_tag", datacatalog_client.delete_taxonomy, name=taxonomy.name)
             print(f"Taxonomía eliminada: {taxonomy.display_name}")
         except Exception as e:
             print(f"No se pudo eliminar {taxonomy.display_name}: {e}")
 
+    # En cada destino solo se elimina la taxonomía del proceso: los proyectos de las reglas pueden tener otras
+    taxonomies = [
+        taxonomy
+        for taxonomias in run_concurrently(listar_taxonomias, scopes_por_destino)
+        for taxonomy in taxonomias if taxonomy.display_name == TAXONOMY_DISPLAY_NAME
+    ]
+    run_concurrently(eliminar_taxonomia, taxonomies)
+    TAXONOMY_CACHE.clear()
+
 # -------------------------------------------------------------------------------------------------------------------
-# Generacion dinamica y aplicacion de las reglas de Masking. Creacion/actualizacion de la tabla de auditoria 
-def apply_masking_from_config():
-    bq_client = bigquery.Client(project=PROJECT_ID)
-    datacatalog_client = datacatalog_v1.PolicyTagManagerClient()
-    audit_table_ref = f"{PROJECT_ID}.{BQ_DATASET}.{BQ_AUDIT_TABLE}"
+# Destinos: cada regla se aplica con la taxonomía de su proyecto en la ubicación de su dataset (una tabla solo puede
+# usar policy tags de su misma ubicación). Las ubicaciones de los datasets y las taxonomías de cada destino
+# (proyecto, ubicación) se cachean por instancia, así las invocaciones en caliente no las vuelven a buscar.
+DATASET_LOCATIONS = {}
+DATASETS_INEXISTENTES = set()
+TAXONOMY_CACHE = {}
 
-    auditoria = []
-    batch_id = 1
+def dataset_location(bq_client, project_id, dataset_id):
+    # Ubicación en el formato de Data Catalog ("US" -> "us"). Un dataset inexistente usa LOCATION y no se cachea:
+    # sus tablas se omiten más adelante, no se consulta su INFORMATION_SCHEMA y puede crearse antes de la próxima corrida.
+    dataset_ref = f"{project_id}.{dataset_id}"
+    if dataset_ref not in DATASET_LOCATIONS:
+        try:
+            dataset = call_api("bigquery", bq_client.get_dataset, dataset_ref)
+        except NotFound:
+            print(f"Dataset inexistente, se usa la ubicación {LOCATION}: {dataset_ref}")
+            DATASETS_INEXISTENTES.add(dataset_ref)
+            return LOCATION
+        DATASETS_INEXISTENTES.discard(dataset_ref)
+        DATASET_LOCATIONS[dataset_ref] = dataset.location.lower()
+    return DATASET_LOCATIONS[dataset_ref]
+
+def scope_target(bq_client, scope):
+    # Destino de un scope de CLEAR_SCOPES: "proyecto.region-us" o "proyecto.dataset"
+    project_id, nombre = scope.split(".", 1)
+    if nombre.startswith("region-"):
+        return project_id, nombre[len("region-"):].lower()
+    return project_id, dataset_location(bq_client, project_id, nombre)
+
+def resolve_targets(bq_client, datasets):
+    # Destino de cada par (proyecto, dataset); las ubicaciones que no están en cache se consultan en paralelo
+    datasets = sorted(set(datasets))
+    ubicaciones = run_concurrently(lambda d: dataset_location(bq_client, *d), datasets)
+    return {(project_id, dataset_id): (project_id, ubicacion) for (project_id, dataset_id), ubicacion in zip(datasets, ubicaciones)}
+
+def target_scopes(bq_client, destinos):
+    # Scopes donde buscar columnas con policy tags, por destino: los de CLEAR_SCOPES más los datasets de las reglas
+    # (destinos: salida de resolve_targets). Los datasets cubiertos por una región de CLEAR_SCOPES no se agregan, y los
+    # inexistentes tampoco: su INFORMATION_SCHEMA no se puede consultar y haría fallar toda la consulta del destino.
+    scopes = {}
+    regiones = set()
+    for scope in CLEAR_SCOPES:
+        destino = scope_target(bq_client, scope)
+        scopes.setdefault(destino, set())
+        if scope not in DATASETS_INEXISTENTES:
+            scopes[destino].add(scope)
+        if ".region-" in scope:
+            regiones.add(destino)
+    for (project_id, dataset_id), destino in destinos.items():
+        scopes.setdefault(destino, set())
+        if destino not in regiones and f"{project_id}.{dataset_id}" not in DATASETS_INEXISTENTES:
+            scopes[destino].add(f"{project_id}.{dataset_id}")
+    return {destino: sorted(scopes_destino) for destino, scopes_destino in sorted(scopes.items())}
+
+def rule_datasets(bq_client):
+    query = f"SELECT DISTINCT project_id, dataset_id FROM `{PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}`"
     try:
-        result = bq_client.query(f"SELECT COALESCE(MAX(batch_id), 0) AS max_batch FROM `{audit_table_ref}`").to_dataframe()
-        batch_id = int(result["max_batch"].iloc[0]) + 1
-    except Exception:
-        pass
+        rows = timed_call("bigquery.query", lambda: bq_client.query(query).result())
+    except NotFound:
+        return set()
+    return {(row.project_id, row.dataset_id) for row in rows}
 
-    # Crear tabla de auditoría si no existe
+# -------------------------------------------------------------------------------------------------------------------
+# Funciones auxiliares compartidas por el modo "full" y el modo "reconcile"
+def get_or_create_taxonomy(datacatalog_client, project_id=None, location=None, crear=True):
+    # Taxonomía del proceso en un destino (por defecto PROJECT_ID/LOCATION). Con crear=False devuelve None si no existe.
+    destino = (project_id or PROJECT_ID, location or LOCATION)
+    if destino in TAXONOMY_CACHE:
+        return TAXONOMY_CACHE[destino]
+
+    parent = f"projects/{destino[0]}/locations/{destino[1]}"
+    for taxonomy in call_api("policy_tag", list_all, datacatalog_client.list_taxonomies, parent=parent):
+        if taxonomy.display_name == TAXONOMY_DISPLAY_NAME:
+            TAXONOMY_CACHE[destino] = taxonomy.name
+            return taxonomy.name
+    if not crear:
+        return None
+
+    taxonomy = datacatalog_v1.Taxonomy(
+        display_name=TAXONOMY_DISPLAY_NAME,
+        activated_policy_types=[datacatalog_v1.Taxonomy.PolicyType.FINE_GRAINED_ACCESS_CONTROL],
+    )
+    taxonomy = call_api("policy_tag", datacatalog_client.create_taxonomy, parent=parent, taxonomy=taxonomy)
+    print(f"Creada nueva taxonomía: {taxonomy.name}")
+    TAXONOMY_CACHE[destino] = taxonomy.name
+    return taxonomy.name
+
+def load_target_registry(datacatalog_client, destino, crear=True):
+    # Taxonomía y registro de policy tags de un destino. Si la taxonomía cacheada fue eliminada fuera del proceso se
+    # descarta del cache y se vuelve a buscar (o crear). Devuelve (None, {}) si no existe y crear=False.
+    for intento in range(2):
+        taxonomy_name = get_or_create_taxonomy(datacatalog_client, *destino, crear=crear)
+        if taxonomy_name is None:
+            return None, {}
+        try:
+            return taxonomy_name, load_policy_tag_registry(datacatalog_client, taxonomy_name)
+        except NotFound:
+            if intento:
+                raise
+            TAXONOMY_CACHE.pop(destino, None)
+
+def ensure_audit_table(bq_client):
+    audit_table_ref = f"{PROJECT_ID}.{BQ_DATASET}.{BQ_AUDIT_TABLE}"
     try:
-        bq_client.get_table(audit_table_ref)
+        timed_call("bigquery.get_table", bq_client.get_table, audit_table_ref)
     except NotFound:
         schema = [
             bigquery.SchemaField("timestamp", "TIMESTAMP"),
@@ -133,91 +671,1115 @@ def apply_masking_from_config():
             bigquery.SchemaField("restricted_users", "STRING"),
             bigquery.SchemaField("batch_id", "INTEGER"),
         ]
-        bq_client.create_table(bigquery.Table(audit_table_ref, schema=schema))
+        timed_call("bigquery.create_table", bq_client.create_table, bigquery.Table(audit_table_ref, schema=schema))
+    return audit_table_ref
 
-    # Leer configuraciones de masking
+def next_batch_id(bq_client):
+    # El batch_id sale de la tabla de corridas (una fila por ejecución) en lugar de un MAX sobre toda la auditoría.
+    # La primera vez se crea la tabla y se siembra con el último batch_id auditado (única lectura de la auditoría).
+    runs_table_ref = f"{PROJECT_ID}.{BQ_DATASET}.{BQ_RUNS_TABLE}"
+    audit_table_ref = f"{PROJECT_ID}.{BQ_DATASET}.{BQ_AUDIT_TABLE}"
+    try:
+        try:
+            timed_call("bigquery.get_table", bq_client.get_table, runs_table_ref)
+        except NotFound:
+            schema = [
+                bigquery.SchemaField("batch_id", "INTEGER"),
+                bigquery.SchemaField("started_at", "TIMESTAMP"),
+            ]
+            timed_call("bigquery.create_table", bq_client.create_table, bigquery.Table(runs_table_ref, schema=schema))
+            timed_call("bigquery.query", lambda: bq_client.query(f"""
+                INSERT INTO `{runs_table_ref}` (batch_id, started_at)
+                SELECT COALESCE(MAX(batch_id), 0), CURRENT_TIMESTAMP() FROM `{audit_table_ref}`
+            """).result())
+
+        rows = timed_call("bigquery.query", lambda: bq_client.query(f"""
+            DECLARE next_id INT64 DEFAULT (SELECT COALESCE(MAX(batch_id), 0) + 1 FROM `{runs_table_ref}`);
+            INSERT INTO `{runs_table_ref}` (batch_id, started_at) VALUES (next_id, CURRENT_TIMESTAMP());
+            SELECT next_id AS batch_id;
+        """).result())
+        return next(iter(rows)).batch_id
+    except Exception as e:
+        # Sin tabla de corridas disponible se usa un id generado a partir del momento de ejecución
+        print(f"No se pudo obtener el batch_id de {runs_table_ref}, se genera uno: {e}")
+        return int(datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+
+def parse_restricted_users(value):
+    return sorted({u.strip() for u in (value or "").split(",") if u.strip()})
+
+def policy_tag_for_rule(table_id, column_name, restricted_users):
+    # Nombre y descripción del policy tag de una regla. Con ESQUEMA_POLICY_TAGS = "usuarios" todas las columnas con el
+    # mismo conjunto normalizado de usuarios comparten un tag (y una única política IAM); el nombre es un hash del
+    # conjunto porque los display names de Data Catalog admiten hasta 200 caracteres.
+    if ESQUEMA_POLICY_TAGS == "usuarios":
+        clave = ",".join(restricted_users)
+        display_name = f"usuarios_{hashlib.sha1(clave.encode('utf-8')).hexdigest()[:16]}"
+        return display_name, f"Columnas ocultas para: {clave}"[:2000]
+    # Los display names no admiten puntos: los campos anidados ("payload.user.email") usan "_" como separador
+    return f"{table_id}_{column_name.replace('.', '_')}_mask", f"Oculta columna {column_name} en {table_id}"
+
+@timed_stage("lectura_reglas")
+def read_masking_rules(bq_client):
     query = f"SELECT project_id, dataset_id, table_id, column_name, restricted_users FROM `{PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}`"
-    rows = bq_client.query(query).result()
-
-    # Obtener o crear taxonomía
-    parent = f"projects/{PROJECT_ID}/locations/{LOCATION}"
-    taxonomy_name = None
-    for taxonomy in datacatalog_client.list_taxonomies(parent=parent):
-        if taxonomy.display_name == "Masking":
-            taxonomy_name = taxonomy.name
-            break
-
-    if not taxonomy_name:
-        taxonomy = datacatalog_v1.Taxonomy(
-            display_name="Masking",
-            activated_policy_types=[datacatalog_v1.Taxonomy.PolicyType.FINE_GRAINED_ACCESS_CONTROL],
+    reglas = {}
+    for row in timed_call("bigquery.query", lambda: bq_client.query(query).result()):
+        key = (row.project_id, row.dataset_id, row.table_id, row.column_name)
+        restricted_users = parse_restricted_users(row.restricted_users)
+        policy_tag_display_name, description = policy_tag_for_rule(row.table_id, row.column_name, restricted_users)
+        reglas[key] = {
+            "policy_tag_display_name": policy_tag_display_name,
+            "description": description,
+            "restricted_users": restricted_users,
+        }
+    return reglas
+
+def taxonomy_version(datacatalog_client, taxonomy_name):
+    taxonomy = call_api("policy_tag", datacatalog_client.get_taxonomy, name=taxonomy_name)
+    return f"{taxonomy_name}@{taxonomy.taxonomy_timestamps.update_time}"
+
+def list_policy_tags_by_name(datacatalog_client, taxonomy_name):
+    policy_tags = call_api("policy_tag", list_all, datacatalog_client.list_policy_tags, parent=taxonomy_name)
+    return {t.display_name: t.name for t in policy_tags}
+
+def policy_tag_cache_path(taxonomy_name):
+    # Un archivo de cache por taxonomía, así los destinos procesados en paralelo no comparten el archivo
+    base, extension = os.path.splitext(POLICY_TAG_CACHE_PATH)
+    return f"{base}_{hashlib.sha1(taxonomy_name.encode('utf-8')).hexdigest()[:12]}{extension}"
+
+@timed_stage("listado_policy_tags")
+def load_policy_tag_registry(datacatalog_client, taxonomy_name):
+    # Registro en memoria display_name -> resource name: la taxonomía se lista una sola vez por corrida.
+    # Si el cache local corresponde a la misma versión de la taxonomía se evita el listado.
+    if POLICY_TAG_CACHE_PATH:
+        try:
+            with open(policy_tag_cache_path(taxonomy_name)) as f:
+                cache = json.load(f)
+            if cache.get("version") == taxonomy_version(datacatalog_client, taxonomy_name):
+                print(f"Policy Tags leídos del cache local: {len(cache['tags'])}")
+                return cache["tags"]
+        except (OSError, ValueError, KeyError):
+            pass
+    return list_policy_tags_by_name(datacatalog_client, taxonomy_name)
+
+def save_policy_tag_registry(datacatalog_client, taxonomy_name, registry):
+    if not POLICY_TAG_CACHE_PATH:
+        return
+    try:
+        with open(policy_tag_cache_path(taxonomy_name), "w") as f:
+            json.dump({"version": taxonomy_version(datacatalog_client, taxonomy_name), "tags": registry}, f)
+    except OSError as e:
+        print(f"No se pudo guardar el cache de Policy Tags: {e}")
+
+def get_or_create_policy_tag(datacatalog_client, taxonomy_name, registry, display_name, description):
+    if display_name in registry:
+        return registry[display_name]
+    try:
+        policy_tag = datacatalog_v1.PolicyTag(display_name=display_name, description=description)
+        policy_tag_obj = call_api("policy_tag", datacatalog_client.create_policy_tag, parent=taxonomy_name, policy_tag=policy_tag)
+        registry[display_name] = policy_tag_obj.name
+        METRICS.count("policy_tags_creados")
+        print(f"Policy Tag creado: {policy_tag_obj.name}")
+    except AlreadyExists:
+        # El registro estaba desactualizado (cache viejo o cambio externo): se vuelve a listar la taxonomía
+        registry.update(list_policy_tags_by_name(datacatalog_client, taxonomy_name))
+    return registry[display_name]
+
+@timed_stage("descubrimiento_columnas")
+def discover_tagged_columns(bq_client, scopes=None):
+    # Una consulta a INFORMATION_SCHEMA.COLUMN_FIELD_PATHS por ubicación (UNION ALL de sus datasets/proyectos, ya que
+    # solo se pueden consultar juntos scopes de la misma ubicación) reemplaza el get_table de cada tabla: solo se
+    # devuelven las tablas que realmente tienen policy tags. Las ubicaciones se consultan en paralelo.
+    # Devuelve tabla -> ruta de campo ("payload.user.email", también los anidados) -> policy tags del campo, así quien
+    # llama puede quedarse solo con los tags de la taxonomía del proceso.
+    scopes_por_ubicacion = {}
+    for scope in CLEAR_SCOPES if scopes is None else scopes:
+        scopes_por_ubicacion.setdefault(scope_target(bq_client, scope)[1], []).append(scope)
+
+    def consultar(item):
+        ubicacion, scopes_ubicacion = item
+        query = "\nUNION ALL\n".join(
+            f"""SELECT table_catalog, table_schema, table_name, field_path, policy_tags
+            FROM `{scope}.INFORMATION_SCHEMA.COLUMN_FIELD_PATHS`
+            WHERE ARRAY_LENGTH(policy_tags) > 0"""
+            for scope in scopes_ubicacion
         )
-        taxonomy = datacatalog_client.create_taxonomy(parent=parent, taxonomy=taxonomy)
-        taxonomy_name = taxonomy.name
+        return list(timed_call("bigquery.query", lambda: bq_client.query(query, location=ubicacion).result()))
+
+    columnas_por_tabla = {}
+    for rows in run_concurrently(consultar, sorted(scopes_por_ubicacion.items())):
+        for row in rows:
+            table_ref = f"{row.table_catalog}.{row.table_schema}.{row.table_name}"
+            columnas_por_tabla.setdefault(table_ref, {})[row.field_path] = list(row.policy_tags)
+    return columnas_por_tabla
+
+def build_restrictions(reglas, policy_tags):
+    # Usuarios restringidos por policy tag, calculados en una sola pasada sobre las reglas
+    restricciones = {}
+    for regla in reglas.values():
+        policy_tag_name = policy_tags.get(regla["policy_tag_display_name"])
+        if policy_tag_name:
+            restricciones.setdefault(policy_tag_name, set()).update(regla["restricted_users"])
+    return restricciones
+
+def build_restricted_policy(policy, restricted_members):
+    # Bindings deseadas: las actuales sin los usuarios restringidos. Devuelve None si la política ya es correcta.
+    new_policy = policy_pb2.Policy()
+    new_policy.CopyFrom(policy)
+    del new_policy.bindings[:]
+    modificada = False
+    for binding in policy.bindings:
+        allowed_members = [m for m in binding.members if m not in restricted_members]
+        modificada = modificada or len(allowed_members) != len(binding.members)
+        if allowed_members:
+            new_binding = new_policy.bindings.add()
+            new_binding.CopyFrom(binding)
+            del new_binding.members[:]
+            new_binding.members.extend(allowed_members)
+    return new_policy if modificada else None
+
+@timed_stage("iam")
+def apply_iam_policies(datacatalog_client, restricciones, completados=None):
+    # Un get_iam_policy por tag; set_iam_policy solo cuando las bindings cambian. El etag copiado de la política
+    # leída hace que una modificación concurrente falle en lugar de pisarse.
+    # completados (opcional) acumula los tags ya verificados, para que una corrida retomada no los vuelva a leer.
+    def restringir(item):
+        policy_tag_name, restricted_users = item
+        if time_budget_exceeded():
+            return None
+        restricted_members = {f"user:{u}" for u in restricted_users}
+        policy = call_api("iam", datacatalog_client.get_iam_policy, request={"resource": policy_tag_name})
+        new_policy = build_restricted_policy(policy, restricted_members)
+        if new_policy is not None:
+            call_api("iam", datacatalog_client.set_iam_policy, request={"resource": policy_tag_name, "policy": new_policy})
+            METRICS.count("politicas_iam_actualizadas")
+            print(f"Acceso restringido a {sorted(restricted_users)} en {policy_tag_name}")
+        if completados is not None:
+            completados.add(policy_tag_name)
+        return new_policy is not None
+
+    resultados = run_concurrently(restringir, restricciones.items())
+    if None in resultados:
+        raise TimeBudgetExceeded(f"Revocación de accesos incompleta: quedan {resultados.count(None)} policy tags")
+    return resultados.count(True)
+
+def field_path_index(campos, prefijo=""):
+    # Índice ruta con puntos ("payload.user.email") -> campo en formato API, armado en una sola pasada recursiva.
+    # Los valores son los mismos dicts del schema: editar un campo del índice edita el schema completo.
+    indice = {}
+    for campo in campos:
+        ruta = f"{prefijo}{campo['name']}"
+        indice[ruta] = campo
+        if campo.get("fields"):
+            indice.update(field_path_index(campo["fields"], f"{ruta}."))
+    return indice
 
-    # Preparar auditoría
-    auditoria = []
+def leaf_policy_tags(table):
+    # Policy tag actual (o None) de cada campo hoja, incluidos los anidados en RECORDs: son los únicos que aceptan tags
+    indice = field_path_index([field.to_api_repr() for field in table.schema])
+    return {
+        ruta: ((campo.get("policyTags") or {}).get("names") or [None])[0]
+        for ruta, campo in indice.items() if not campo.get("fields")
+    }
 
+def rewrite_table_schema(bq_client, table_ref, cambios, table=None):
+    # cambios: ruta del campo -> policy tag (None lo quita). Se edita la representación API del schema a través del
+    # índice de rutas, así cada cambio se resuelve sin recorrer el schema, los demás atributos (description, mode,
+    # maxLength, defaultValueExpression, campos anidados, ...) quedan intactos y la tabla se reescribe una sola vez
+    with table_lock(table_ref):
+        if table is None:
+            table = call_api("bigquery", bq_client.get_table, table_ref)
+        campos = [field.to_api_repr() for field in table.schema]
+        indice = field_path_index(campos)
+        for ruta, policy_tag_name in cambios.items():
+            campo = indice.get(ruta)
+            if campo is None:
+                print(f"Columna inexistente, se omite: {table_ref}.{ruta}")
+                continue
+            if campo.get("fields"):
+                print(f"Los policy tags solo se aplican a campos hoja, se omite el RECORD: {table_ref}.{ruta}")
+                continue
+            if policy_tag_name:
+                campo["policyTags"] = {"names": [policy_tag_name]}
+            else:
+                campo.pop("policyTags", None)
+        table.schema = [bigquery.SchemaField.from_api_repr(campo) for campo in campos]
+        call_api("bigquery", bq_client.update_table, table, ["schema"])
+        METRICS.count("schemas_actualizados")
+        METRICS.count("columnas_actualizadas", len(cambios))
+
+def audit_row(taxonomy_name, policy_tag_name, project_id, dataset_id, table_id, column_name, restricted_users, batch_id):
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "taxonomy_name": taxonomy_name,
+        "policy_tag_name": policy_tag_name,
+        "project_id": project_id,
+        "dataset_id": dataset_id,
+        "table_id": table_id,
+        "column_name": column_name,
+        "restricted_users": ",".join(restricted_users),
+        "batch_id": batch_id,
+    }
+
+# -------------------------------------------------------------------------------------------------------------------
+# Generacion dinamica y aplicacion de las reglas de Masking. Creacion/actualizacion de la tabla de auditoria 
+@timed_stage("aplicacion")
+def apply_masking_from_config(checkpoint=None):
+    # Con checkpoint (invocación desde main) se omiten las tablas ya completadas y se reutiliza el batch_id; el progreso
+    # se guarda cada CHECKPOINT_CADA_TABLAS tablas y al agotarse el tiempo. Los policy tags creados en una invocación
+    # anterior no se guardan en el checkpoint: ya existen en la taxonomía y el registro los vuelve a listar.
+    bq_client = get_bq_client()
+    datacatalog_client = get_datacatalog_client()
+
+    # Crear tabla de auditoría si no existe
+    audit_table_ref = ensure_audit_table(bq_client)
+    if checkpoint is not None and checkpoint.get("batch_id"):
+        batch_id = checkpoint["batch_id"]
+    else:
+        batch_id = next_batch_id(bq_client)
+
+    # Leer configuraciones de masking
+    query = f"SELECT project_id, dataset_id, table_id, column_name, restricted_users FROM `{PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}`"
+    rows = list(timed_call("bigquery.query", lambda: bq_client.query(query).result()))
+
+    # Obtener o crear la taxonomía y el registro de policy tags de cada destino (proyecto, ubicación), en paralelo
+    destino_por_dataset = resolve_targets(bq_client, {(row.project_id, row.dataset_id) for row in rows})
+    destinos = sorted(set(destino_por_dataset.values()))
+    registros = dict(zip(destinos, run_concurrently(lambda destino: load_target_registry(datacatalog_client, destino), destinos)))
+    METRICS.count("destinos", len(destinos))
+
+    # Agrupar las reglas por tabla: cada tabla se lee y se actualiza una sola vez
+    completadas = set(checkpoint.get("tablas_completadas", [])) if checkpoint is not None else set()
+    reglas_por_tabla = {}
+    destino_por_tabla = {}
+    tag_por_columna = {}
     for row in rows:
-        project_id, dataset_id, table_id, column_name = row.project_id, row.dataset_id, row.table_id, row.column_name
-        restricted_users = [u.strip() for u in row.restricted_users.split(",")]
-        policy_tag_display_name = f"{table_id}_{column_name}_mask"
-
-        # Crear o recuperar policy tag
-        existing_tags = list(datacatalog_client.list_policy_tags(parent=taxonomy_name))
-        existing = next((t for t in existing_tags if t.display_name == policy_tag_display_name), None)
-        if existing:
-            policy_tag_name = existing.name
-        else:
-            policy_tag_obj = datacatalog_client.create_policy_tag(
-                parent=taxonomy_name,
-                policy_tag=datacatalog_v1.PolicyTag(
-                    display_name=policy_tag_display_name,
-                    description=f"Oculta columna {column_name} en {table_id}",
-                ),
+        table_ref = f"{row.project_id}.{row.dataset_id}.{row.table_id}"
+        if table_ref not in completadas:
+            reglas_por_tabla.setdefault(table_ref, []).append(row)
+            destino_por_tabla[table_ref] = destino_por_dataset[(row.project_id, row.dataset_id)]
+            tag_por_columna[(table_ref, row.column_name)] = policy_tag_for_rule(
+                row.table_id, row.column_name, parse_restricted_users(row.restricted_users),
             )
-            policy_tag_name = policy_tag_obj.name
+    if completadas:
+        print(f"Retomando aplicación: {len(completadas)} tablas completadas, {len(reglas_por_tabla)} pendientes")
 
-        # Actualizar schema de BigQuery
-        table_ref = f"{project_id}.{dataset_id}.{table_id}"
-        table = bq_client.get_table(table_ref)
-        new_schema = []
-        for field in table.schema:
-            if field.name == column_name:
-                field = bigquery.SchemaField(
-                    field.name, field.field_type, mode=field.mode,
-                    policy_tags=bigquery.PolicyTagList(names=[policy_tag_name]),
-                )
-            new_schema.append(field)
-        table.schema = new_schema
-        bq_client.update_table(table, ["schema"])
+    # Crear en paralelo (todos los destinos juntos) los policy tags que todavía no existen en el registro de su destino
+    pendientes = {}
+    for (table_ref, _), (display_name, description) in tag_por_columna.items():
+        destino = destino_por_tabla[table_ref]
+        if display_name not in registros[destino][1]:
+            pendientes[(destino, display_name)] = description
+
+    progreso_lock = threading.Lock()
+
+    def guardar_progreso():
+        checkpoint.update(etapa="apply", batch_id=batch_id, tablas_completadas=sorted(completadas))
+        save_checkpoint(checkpoint)
+
+    def guardar_registros():
+        for taxonomy_name, policy_tags in registros.values():
+            save_policy_tag_registry(datacatalog_client, taxonomy_name, policy_tags)
+
+    def crear_tag(item):
+        (destino, display_name), description = item
+        if time_budget_exceeded():
+            return None
+        taxonomy_name, policy_tags = registros[destino]
+        return get_or_create_policy_tag(datacatalog_client, taxonomy_name, policy_tags, display_name, description)
+
+    creados = run_concurrently(crear_tag, pendientes.items())
+    if checkpoint is not None:
+        guardar_progreso()
+    if None in creados:
+        guardar_registros()
+        raise TimeBudgetExceeded(f"Creación de Policy Tags incompleta: quedan {creados.count(None)} pendientes")
+
+    # Actualizar schema de BigQuery: tablas de todos los destinos en paralelo, un único get_table/update_table por tabla.
+    # La auditoría de cada tabla se encola apenas se actualiza (un único batch para toda la corrida), así queda
+    # registrada aunque la corrida falle después.
+    def aplicar_tabla(item):
+        table_ref, table_rows = item
+        if time_budget_exceeded():
+            return False
+        taxonomy_name, policy_tags = registros[destino_por_tabla[table_ref]]
+        cambios = {row.column_name: policy_tags[tag_por_columna[(table_ref, row.column_name)][0]] for row in table_rows}
+        rewrite_table_schema(bq_client, table_ref, cambios)
 
         #  Completa los campos de la tabla de Auditoria
-        auditoria.append({
-            "timestamp": datetime.utcnow().isoformat(),
+        auditoria.extend(
+            audit_row(
+                taxonomy_name, cambios[row.column_name], row.project_id, row.dataset_id,
+                row.table_id, row.column_name, [u.strip() for u in row.restricted_users.split(",")], batch_id,
+            )
+            for row in table_rows
+        )
+        if checkpoint is not None:
+            with progreso_lock:
+                completadas.add(table_ref)
+                if len(completadas) % CHECKPOINT_CADA_TABLAS == 0:
+                    # La auditoría se escribe antes de marcar las tablas como completadas en el checkpoint
+                    auditoria.flush()
+                    guardar_progreso()
+        return True
+
+    with AuditWriter(bq_client, audit_table_ref) as auditoria:
+        resultados = run_concurrently(aplicar_tabla, reglas_por_tabla.items())
+    filas_aplicadas = auditoria.filas_escritas
+    tablas_actualizadas = resultados.count(True)
+
+    print(f"Filas aplicadas: {filas_aplicadas}. Actualizaciones de tabla: {tablas_actualizadas}. Destinos: {len(destinos)}")
+    guardar_registros()
+    if False in resultados:
+        if checkpoint is not None:
+            guardar_progreso()
+        raise TimeBudgetExceeded(f"Aplicación incompleta: quedan {resultados.count(False)} tablas pendientes")
+
+    # Revocar accesos una vez que todas las columnas tienen su tag. Se calcula sobre todas las reglas (no solo las
+    # tablas pendientes); los tags ya verificados en una invocación anterior quedan en el checkpoint.
+    iam_completados = set(checkpoint.get("iam_completados", [])) if checkpoint is not None else set()
+    reglas_por_destino = {}
+    for row in rows:
+        restricted_users = parse_restricted_users(row.restricted_users)
+        reglas_por_destino.setdefault(destino_por_dataset[(row.project_id, row.dataset_id)], {})[
+            (row.project_id, row.dataset_id, row.table_id, row.column_name)
+        ] = {
+            "policy_tag_display_name": policy_tag_for_rule(row.table_id, row.column_name, restricted_users)[0],
+            "restricted_users": restricted_users,
+        }
+    restricciones = {}
+    for destino, reglas in reglas_por_destino.items():
+        restricciones.update(build_restrictions(reglas, registros[destino][1]))
+    restricciones = {t: u for t, u in restricciones.items() if t not in iam_completados}
+    try:
+        actualizadas = apply_iam_policies(datacatalog_client, restricciones, iam_completados)
+    except TimeBudgetExceeded:
+        if checkpoint is not None:
+            checkpoint["iam_completados"] = sorted(iam_completados)
+            guardar_progreso()
+        raise
+    print(f"Políticas IAM actualizadas: {actualizadas} de {len(restricciones)} policy tags")
+
+# -------------------------------------------------------------------------------------------------------------------
+# Reconciliacion incremental: compara el estado actual de la taxonomía, los schemas y el IAM contra las reglas
+# y ejecuta solo las llamadas necesarias. Una corrida sin cambios no realiza llamadas de escritura.
+@timed_stage("lectura_estado")
+def read_current_state(bq_client, taxonomy_name, tags, table_refs, scopes):
+    # Estado de un destino: se inspeccionan las tablas indicadas (las de sus reglas) y las que tienen policy tags dentro
+    # de sus scopes (mismo alcance que clear_existing_policies), sin leer las tablas que no tienen tags
+    table_refs = set(table_refs)
+    if scopes:
+        table_refs |= set(discover_tagged_columns(bq_client, scopes))
+
+    def leer_tabla(table_ref):
+        try:
+            return table_ref, call_api("bigquery", bq_client.get_table, table_ref)
+        except NotFound:
+            print(f"Tabla inexistente, se omite: {table_ref}")
+            return table_ref, None
+
+    tablas = {}
+    columnas_con_tag = {}
+    campos_por_tabla = {}
+    for table_ref, table in run_concurrently(leer_tabla, sorted(table_refs)):
+        if table is None:
+            continue
+        tablas[table_ref] = table
+        hojas = leaf_policy_tags(table)
+        campos_por_tabla[table_ref] = set(hojas)
+        for ruta, policy_tag_name in hojas.items():
+            # Solo se administran los policy tags de la taxonomía del proceso
+            if taxonomy_name and policy_tag_name and policy_tag_name.startswith(f"{taxonomy_name}/"):
+                columnas_con_tag[(table_ref, ruta)] = policy_tag_name
+
+    return {"tags": tags, "tablas": tablas, "columnas_con_tag": columnas_con_tag, "campos": campos_por_tabla}
+
+def compute_reconcile_diff(reglas, estado):
+    tags_deseados = {r["policy_tag_display_name"] for r in reglas.values()}
+    diff = {
+        "crear_tags": sorted(tags_deseados - set(estado["tags"])),
+        "eliminar_tags": sorted(set(estado["tags"]) - tags_deseados),
+        "cambios_por_tabla": {},
+    }
+
+    columnas_deseadas = set()
+    for (project_id, dataset_id, table_id, column_name), regla in reglas.items():
+        table_ref = f"{project_id}.{dataset_id}.{table_id}"
+        if table_ref not in estado["tablas"]:
+            continue
+        if column_name not in estado["campos"][table_ref]:
+            # Campo inexistente o RECORD: no se puede taggear y reescribir la tabla en cada corrida no lo cambiaría
+            print(f"Columna inexistente o RECORD, se omite: {table_ref}.{column_name}")
+            continue
+        columnas_deseadas.add((table_ref, column_name))
+        tag_actual = estado["columnas_con_tag"].get((table_ref, column_name))
+        if tag_actual is None or tag_actual != estado["tags"].get(regla["policy_tag_display_name"]):
+            diff["cambios_por_tabla"].setdefault(table_ref, {})[column_name] = regla["policy_tag_display_name"]
+
+    # Columnas con un tag de la taxonomía que ya no figuran en las reglas: se les quita el tag
+    for (table_ref, column_name) in estado["columnas_con_tag"]:
+        if (table_ref, column_name) not in columnas_deseadas:
+            diff["cambios_por_tabla"].setdefault(table_ref, {})[column_name] = None
+
+    return diff
+
+def read_target_groups(bq_client, datacatalog_client, reglas, delta=None, crear=True):
+    # Lectura del estado y diff de cada destino (proyecto, ubicación), compartida por la reconciliación y el plan.
+    # Con delta (salida de compute_rules_delta) solo se leen las tablas de las reglas agregadas, eliminadas o
+    # modificadas, sin recorrer CLEAR_SCOPES, y solo se eliminan los tags anteriores que ya no usa ninguna regla.
+    # Con crear=False no se crean taxonomías: los destinos con reglas y sin taxonomía quedan con taxonomy_name None.
+    if delta is None:
+        destino_por_dataset = resolve_targets(bq_client, {(p, d) for (p, d, _, _) in reglas})
+        scopes_por_destino = target_scopes(bq_client, destino_por_dataset)
+        alcance = reglas
+        tablas_delta = set()
+    else:
+        anteriores = {**delta["eliminadas"], **{clave: anterior for clave, (anterior, _) in delta["modificadas"].items()}}
+        claves = set(delta["agregadas"]) | set(anteriores)
+        tablas_delta = {clave[:3] for clave in claves}
+        destino_por_dataset = resolve_targets(bq_client, {clave[:2] for clave in claves})
+        scopes_por_destino = {destino: [] for destino in sorted(set(destino_por_dataset.values()))}
+        # Todas las reglas vigentes de las tablas afectadas, para que el diff no les quite los tags a sus otras columnas
+        alcance = {clave: regla for clave, regla in reglas.items() if clave[:3] in tablas_delta}
+        tags_anteriores = {
+            policy_tag_for_rule(clave[2], clave[3], parse_restricted_users(fila["restricted_users"]))[0]
+            for clave, fila in anteriores.items()
+        }
+        tags_en_uso = {regla["policy_tag_display_name"] for regla in reglas.values()}
+    reglas_por_destino = {}
+    for clave, regla in alcance.items():
+        reglas_por_destino.setdefault(destino_por_dataset[clave[:2]], {})[clave] = regla
+
+    # Estado y diff de cada destino (proyecto, ubicación) en paralelo. En los destinos que solo figuran en CLEAR_SCOPES
+    # (o en las reglas eliminadas) no se crea la taxonomía: si existe, se les quitan los tags que ya no tienen reglas.
+    def leer_destino(destino):
+        reglas_destino = reglas_por_destino.get(destino, {})
+        taxonomy_name, tags = load_target_registry(datacatalog_client, destino, crear=crear and bool(reglas_destino))
+        if taxonomy_name is None and not reglas_destino:
+            return None
+        table_refs = {f"{p}.{d}.{t}" for (p, d, t, _) in reglas_destino}
+        table_refs |= {f"{p}.{d}.{t}" for (p, d, t) in tablas_delta if destino_por_dataset[(p, d)] == destino}
+        estado = read_current_state(bq_client, taxonomy_name, tags, table_refs, scopes_por_destino[destino])
+        diff = compute_reconcile_diff(reglas_destino, estado)
+        if delta is not None:
+            diff["eliminar_tags"] = sorted((tags_anteriores & set(estado["tags"])) - tags_en_uso)
+        return {
+            "destino": destino,
             "taxonomy_name": taxonomy_name,
-            "policy_tag_name": policy_tag_name,
-            "project_id": project_id,
-            "dataset_id": dataset_id,
-            "table_id": table_id,
-            "column_name": column_name,
-            "restricted_users": ",".join(restricted_users),
-            "batch_id": batch_id
-        })
+            "reglas": reglas_destino,
+            "estado": estado,
+            "diff": diff,
+        }
+
+    grupos = [g for g in run_concurrently(leer_destino, list(scopes_por_destino)) if g is not None]
+    METRICS.count("destinos", len(grupos))
+    return grupos
+
+@timed_stage("reconciliacion")
+def reconcile_masking_policies(checkpoint=None, delta=None):
+    # Con delta solo se modifican las tablas afectadas y se revisa el IAM solo de los tags de las reglas agregadas o
+    # modificadas (ver read_target_groups)
+    bq_client = get_bq_client()
+    datacatalog_client = get_datacatalog_client()
 
-    # Insertar auditoría en batch
-    bq_client.insert_rows_json(audit_table_ref, auditoria)
+    reglas = read_masking_rules(bq_client)
+    grupos = read_target_groups(bq_client, datacatalog_client, reglas, delta)
+    descripciones = {r["policy_tag_display_name"]: r["description"] for r in reglas.values()}
+    mutaciones = 0
+
+    def guardar_registros():
+        for grupo in grupos:
+            save_policy_tag_registry(datacatalog_client, grupo["taxonomy_name"], grupo["estado"]["tags"])
+
+    # Si el tiempo se agota, cada paso termina lo que está en curso y corta: la siguiente invocación recalcula el diff
+    # y solo encuentra lo que quedó pendiente. Cada paso procesa juntos los elementos de todos los destinos.
+    def cortar_si_incompleto(resultados, etapa):
+        pendientes = sum(1 for r in resultados if r is None)
+        if pendientes:
+            guardar_registros()
+            raise TimeBudgetExceeded(f"Reconciliación incompleta ({etapa}): quedan {pendientes} pendientes")
+
+    # 1. Crear los policy tags faltantes
+    def crear_tag(item):
+        grupo, display_name = item
+        if time_budget_exceeded():
+            return None
+        return get_or_create_policy_tag(
+            datacatalog_client, grupo["taxonomy_name"], grupo["estado"]["tags"], display_name, descripciones[display_name],
+        )
+
+    crear_tags = [(grupo, display_name) for grupo in grupos for display_name in grupo["diff"]["crear_tags"]]
+    cortar_si_incompleto(run_concurrently(crear_tag, crear_tags), "policy tags")
+    mutaciones += len(crear_tags)
+
+    # 2. Asociar/desasociar tags: una única actualización de schema por tabla modificada, tablas en paralelo.
+    # Solo se auditan las columnas a las que se les aplicó un tag, a medida que se actualiza cada tabla, todas con el
+    # mismo batch_id. El batch_id se guarda en el checkpoint apenas se obtiene, así una corrida que termina en varias
+    # invocaciones audita todo bajo un único batch_id (como el modo "full").
+    claves_por_tabla = {f"{p}.{d}.{t}": (p, d, t) for (p, d, t, _) in reglas}
+    cambios_por_tabla = [
+        (grupo, table_ref, cambios) for grupo in grupos for table_ref, cambios in grupo["diff"]["cambios_por_tabla"].items()
+    ]
+    audit_table_ref = None
+    batch_id = None
+    if any(d for _, _, cambios in cambios_por_tabla for d in cambios.values()):
+        audit_table_ref = ensure_audit_table(bq_client)
+        if checkpoint is not None and checkpoint.get("batch_id"):
+            batch_id = checkpoint["batch_id"]
+        else:
+            batch_id = next_batch_id(bq_client)
+            if checkpoint is not None:
+                checkpoint["batch_id"] = batch_id
+                save_checkpoint(checkpoint)
+
+    def actualizar_tabla(item):
+        grupo, table_ref, cambios = item
+        if time_budget_exceeded():
+            return None
+        tags = grupo["estado"]["tags"]
+        rewrite_table_schema(
+            bq_client, table_ref, {c: tags[d] if d else None for c, d in cambios.items()}, table=grupo["estado"]["tablas"][table_ref],
+        )
+        print(f"Schema actualizado en {table_ref}: {len(cambios)} columnas")
+        if table_ref in claves_por_tabla:
+            project_id, dataset_id, table_id = claves_por_tabla[table_ref]
+            auditoria.extend(
+                audit_row(
+                    grupo["taxonomy_name"], tags[d], project_id, dataset_id, table_id, column_name,
+                    reglas[(project_id, dataset_id, table_id, column_name)]["restricted_users"], batch_id,
+                )
+                for column_name, d in cambios.items() if d
+            )
+        return True
+
+    with AuditWriter(bq_client, audit_table_ref) as auditoria:
+        resultados = run_concurrently(actualizar_tabla, cambios_por_tabla)
+    mutaciones += resultados.count(True)
+    cortar_si_incompleto(resultados, "schemas")
+
+    # 3. Revocar acceso solo donde las bindings actuales incluyen usuarios restringidos. Es el único paso que no se
+    # achica al recalcular el diff, por eso los tags ya verificados se guardan en el checkpoint.
+    iam_completados = set(checkpoint.get("iam_completados", [])) if checkpoint is not None else set()
+    restricciones = {}
+    for grupo in grupos:
+        reglas_iam = grupo["reglas"]
+        if delta is not None:
+            reglas_iam = {c: r for c, r in reglas_iam.items() if c in delta["agregadas"] or c in delta["modificadas"]}
+        restricciones.update(build_restrictions(reglas_iam, grupo["estado"]["tags"]))
+    restricciones = {t: u for t, u in restricciones.items() if t not in iam_completados}
+    try:
+        mutaciones += apply_iam_policies(datacatalog_client, restricciones, iam_completados)
+    except TimeBudgetExceeded:
+        if checkpoint is not None:
+            checkpoint["iam_completados"] = sorted(iam_completados)
+            save_checkpoint(checkpoint)
+        raise
+
+    # 4. Eliminar los policy tags que ya no se usan (ya desasociados en el paso 2)
+    def eliminar_tag(item):
+        grupo, display_name = item
+        if time_budget_exceeded():
+            return None
+        call_api("policy_tag", datacatalog_client.delete_policy_tag, name=grupo["estado"]["tags"][display_name])
+        grupo["estado"]["tags"].pop(display_name)
+        METRICS.count("policy_tags_eliminados")
+        print(f"Policy Tag eliminado: {display_name}")
+        return True
+
+    eliminar_tags = [(grupo, display_name) for grupo in grupos for display_name in grupo["diff"]["eliminar_tags"]]
+    resultados = run_concurrently(eliminar_tag, eliminar_tags)
+    mutaciones += resultados.count(True)
+    cortar_si_incompleto(resultados, "eliminación de policy tags")
+
+    guardar_registros()
+    print(f"Reconciliación completada en {len(grupos)} destinos. Llamadas de escritura: {mutaciones}")
+    return mutaciones
+
+# -------------------------------------------------------------------------------------------------------------------
+# Plan y aplicación separados: el plan lee las reglas y el estado actual (taxonomías, schemas e IAM) una sola vez y
+# guarda en GCS la lista de operaciones a realizar, con una estimación de llamadas a APIs y tiempo por tipo de
+# operación. La aplicación ejecuta exactamente las operaciones del plan guardado, sin volver a leer el estado.
+TIPOS_OPERACION = ["crear_taxonomia", "crear_policy_tag", "actualizar_schema", "restringir_iam", "eliminar_policy_tag"]
+
+class StalePlanError(Exception):
+    pass
+
+def plan_blob():
+    return get_storage_client().bucket(BUCKET_NAME.replace("gs://", "")).blob(PLAN_PATH)
+
+def save_plan(plan):
+    timed_call("storage.upload_from_string", plan_blob().upload_from_string, json.dumps(plan, ensure_ascii=False), content_type="application/json")
+
+def read_plan():
+    blob = timed_call("storage.get_blob", get_storage_client().bucket(BUCKET_NAME.replace("gs://", "")).get_blob, PLAN_PATH)
+    if blob is None:
+        return None
+    return json.loads(timed_call("storage.download_as_text", blob.download_as_text))
+
+def delete_plan():
+    try:
+        timed_call("storage.delete", plan_blob().delete)
+    except NotFound:
+        pass
+
+def operation_calls(operacion):
+    # Llamadas a APIs que realiza cada operación al aplicarse
+    tipo = operacion["tipo"]
+    if tipo == "crear_taxonomia":
+        return {"policy_tag.create_taxonomy": 1}
+    if tipo == "crear_policy_tag":
+        return {"policy_tag.create_policy_tag": 1}
+    if tipo == "actualizar_schema":
+        return {"bigquery.get_table": 1, "bigquery.update_table": 1}
+    if tipo == "restringir_iam":
+        # Sin política precalculada (tag creado por el mismo plan) se lee la política antes de escribirla
+        return {"iam.set_iam_policy": 1} if operacion.get("politica") else {"iam.get_iam_policy": 1, "iam.set_iam_policy": 1}
+    return {"policy_tag.delete_policy_tag": 1}
+
+def estimate_plan(operaciones):
+    # Llamadas por método y tiempo estimado por tipo de operación. El tiempo de cada método es el mayor entre lo que
+    # permiten MAX_WORKERS llamadas concurrentes y su rate limit; la latencia es la observada al armar el plan o,
+    # si el método no se llamó (escrituras), la de PLAN_LATENCIA_MS.
+    llamadas_por_tipo = {}
+    for operacion in operaciones:
+        llamadas = llamadas_por_tipo.setdefault(operacion["tipo"], {})
+        for metodo, cantidad in operation_calls(operacion).items():
+            llamadas[metodo] = llamadas.get(metodo, 0) + cantidad
+    filas_auditoria = sum(len(op.get("auditoria", [])) for op in operaciones)
+    if filas_auditoria:
+        llamadas_por_tipo["auditoria"] = {
+            "bigquery.query": 1,
+            "bigquery.insert_rows_json": -(-filas_auditoria // AUDIT_CHUNK_ROWS),
+        }
+
+    estimacion = {}
+    for tipo, llamadas in llamadas_por_tipo.items():
+        segundos = 0.0
+        for metodo, cantidad in llamadas.items():
+            family = metodo.split(".")[0]
+            latencia = METRICS.mean_latency_ms(metodo) or PLAN_LATENCIA_MS[family]
+            segundos += max(cantidad * latencia / 1000 / max(MAX_WORKERS, 1), cantidad / API_RATE_LIMITS[family])
+        estimacion[tipo] = {
+            **({"filas": filas_auditoria} if tipo == "auditoria" else {"operaciones": sum(1 for op in operaciones if op["tipo"] == tipo)}),
+            "llamadas_api": llamadas,
+            "segundos": round(segundos, 1),
+        }
+    estimacion["total"] = {
+        "operaciones": len(operaciones),
+        "llamadas_api": sum(sum(e["llamadas_api"].values()) for e in estimacion.values()),
+        "segundos": round(sum(e["segundos"] for e in estimacion.values()), 1),
+    }
+    return estimacion
+
+@timed_stage("plan")
+def build_masking_plan(fuente=None):
+    # Solo lecturas: las taxonomías faltantes quedan como operaciones y las políticas IAM se leen acá, así la
+    # aplicación escribe directamente la política calculada (con el etag leído, que detecta cambios posteriores)
+    bq_client = get_bq_client()
+    datacatalog_client = get_datacatalog_client()
+
+    reglas = read_masking_rules(bq_client)
+    grupos = read_target_groups(bq_client, datacatalog_client, reglas, crear=False)
+    descripciones = {r["policy_tag_display_name"]: r["description"] for r in reglas.values()}
+    operaciones = []
+
+    def agregar(tipo, grupo, **campos):
+        operaciones.append({"id": len(operaciones), "tipo": tipo, "destino": list(grupo["destino"]), **campos})
+
+    for grupo in grupos:
+        if grupo["taxonomy_name"] is None:
+            agregar("crear_taxonomia", grupo)
+        for display_name in grupo["diff"]["crear_tags"]:
+            agregar("crear_policy_tag", grupo, display_name=display_name, description=descripciones[display_name])
+
+    for grupo in grupos:
+        for table_ref, cambios in sorted(grupo["diff"]["cambios_por_tabla"].items()):
+            project_id, dataset_id, table_id = table_ref.split(".")
+            agregar(
+                "actualizar_schema", grupo, table_ref=table_ref, etag=grupo["estado"]["tablas"][table_ref].etag, cambios=cambios,
+                auditoria=[
+                    [column_name, grupo["reglas"][(project_id, dataset_id, table_id, column_name)]["restricted_users"]]
+                    for column_name, display_name in cambios.items() if display_name
+                ],
+            )
+
+    # Políticas IAM: se leen en paralelo las de los tags existentes y solo se planifican las que cambian
+    restricciones = []
+    for grupo in grupos:
+        restringidos = {}
+        for regla in grupo["reglas"].values():
+            restringidos.setdefault(regla["policy_tag_display_name"], set()).update(regla["restricted_users"])
+        restricciones.extend((grupo, display_name, sorted(users)) for display_name, users in sorted(restringidos.items()))
+
+    def planificar_iam(item):
+        grupo, display_name, restricted_users = item
+        policy_tag_name = grupo["estado"]["tags"].get(display_name)
+        if policy_tag_name is None:
+            return item, None
+        policy = call_api("iam", datacatalog_client.get_iam_policy, request={"resource": policy_tag_name})
+        new_policy = build_restricted_policy(policy, {f"user:{u}" for u in restricted_users})
+        return item, (False if new_policy is None else base64.b64encode(new_policy.SerializeToString()).decode())
+
+    for (grupo, display_name, restricted_users), politica in run_concurrently(planificar_iam, restricciones):
+        if politica is not False:
+            agregar("restringir_iam", grupo, display_name=display_name, restricted_users=restricted_users, politica=politica)
+
+    for grupo in grupos:
+        for display_name in grupo["diff"]["eliminar_tags"]:
+            agregar("eliminar_policy_tag", grupo, display_name=display_name, policy_tag_name=grupo["estado"]["tags"][display_name])
+
+    creado = datetime.utcnow().isoformat()
+    plan = {
+        "id": hashlib.sha1(f"{creado}{json.dumps(operaciones, sort_keys=True)}".encode("utf-8")).hexdigest()[:16],
+        "creado": creado,
+        "fuente": fuente,
+        "esquema_policy_tags": ESQUEMA_POLICY_TAGS,
+        "operaciones": operaciones,
+    }
+    plan["estimacion"] = estimate_plan(operaciones)
+    return plan
+
+@timed_stage("aplicacion_plan")
+def apply_masking_plan(plan, checkpoint=None):
+    # Ejecuta las operaciones del plan por tipo, en el mismo orden que la reconciliación. Las operaciones ya
+    # completadas (checkpoint de una invocación anterior) se omiten. Una operación que falla no frena al resto: se
+    # informa y queda pendiente para un reintento. Si falló porque el estado cambió después del plan (tabla o política
+    # IAM con otro etag) reintentarla no sirve: hay que armar un plan nuevo.
+    bq_client = get_bq_client()
+    datacatalog_client = get_datacatalog_client()
+
+    completadas = set(checkpoint.get("operaciones_completadas", [])) if checkpoint is not None else set()
+    por_tipo = {tipo: [] for tipo in TIPOS_OPERACION}
+    for operacion in plan["operaciones"]:
+        if operacion["id"] not in completadas:
+            por_tipo[operacion["tipo"]].append(operacion)
+    if completadas:
+        print(f"Retomando plan {plan['id']}: {len(completadas)} operaciones completadas")
+
+    registros = {}
+    errores = {}
+    desactualizadas = set()
+    progreso_lock = threading.Lock()
+
+    def guardar_progreso():
+        if checkpoint is not None:
+            checkpoint.update(etapa="apply_plan", plan_id=plan["id"], operaciones_completadas=sorted(completadas))
+            save_checkpoint(checkpoint)
+
+    def guardar_registros():
+        for taxonomy_name, registry in registros.values():
+            if taxonomy_name:
+                save_policy_tag_registry(datacatalog_client, taxonomy_name, registry)
+
+    def ejecutar(fn):
+        # Devuelve None si se agotó el tiempo, False si la operación falló y True si se completó
+        def wrapper(operacion):
+            if time_budget_exceeded():
+                return None
+            try:
+                fn(operacion)
+            except Exception as e:
+                errores[operacion["id"]] = str(e)
+                if isinstance(e, StalePlanError):
+                    desactualizadas.add(operacion["id"])
+                log_event("operacion_fallida", severity="ERROR", id=operacion["id"], tipo=operacion["tipo"], error=str(e))
+                return False
+            with progreso_lock:
+                completadas.add(operacion["id"])
+            return True
+        return wrapper
+
+    def ejecutar_tipo(tipo, fn):
+        resultados = run_concurrently(ejecutar(fn), por_tipo[tipo])
+        METRICS.count(f"plan_{tipo}", resultados.count(True))
+        if None in resultados:
+            guardar_progreso()
+            guardar_registros()
+            raise TimeBudgetExceeded(f"Plan incompleto ({tipo}): quedan {resultados.count(None)} operaciones")
+
+    def registro(destino):
+        return registros[tuple(destino)]
+
+    # 1. Taxonomías faltantes; luego el registro de policy tags de cada destino del plan
+    ejecutar_tipo("crear_taxonomia", lambda op: get_or_create_taxonomy(datacatalog_client, *op["destino"]))
+    destinos = sorted({tuple(op["destino"]) for ops in por_tipo.values() for op in ops})
+    registros.update(zip(destinos, run_concurrently(lambda d: load_target_registry(datacatalog_client, d, crear=False), destinos)))
+
+    # 2. Policy tags
+    def crear_tag(op):
+        taxonomy_name, registry = registro(op["destino"])
+        get_or_create_policy_tag(datacatalog_client, taxonomy_name, registry, op["display_name"], op["description"])
+
+    ejecutar_tipo("crear_policy_tag", crear_tag)
+
+    # 3. Schemas: se verifica que la tabla no haya cambiado desde el plan (etag) antes de reescribirla
+    audit_table_ref = None
+    batch_id = None
+    if any(op.get("auditoria") for op in por_tipo["actualizar_schema"]):
+        audit_table_ref = ensure_audit_table(bq_client)
+        batch_id = checkpoint.get("batch_id") if checkpoint is not None and checkpoint.get("batch_id") else next_batch_id(bq_client)
+        if checkpoint is not None:
+            checkpoint["batch_id"] = batch_id
+
+    def actualizar_schema(op):
+        taxonomy_name, registry = registro(op["destino"])
+        table = call_api("bigquery", bq_client.get_table, op["table_ref"])
+        if op["etag"] and table.etag != op["etag"]:
+            raise StalePlanError(f"La tabla {op['table_ref']} cambió después de armar el plan")
+        rewrite_table_schema(bq_client, op["table_ref"], {c: registry[d] if d else None for c, d in op["cambios"].items()}, table=table)
+        project_id, dataset_id, table_id = op["table_ref"].split(".")
+        auditoria.extend(
+            audit_row(taxonomy_name, registry[op["cambios"][column_name]], project_id, dataset_id, table_id, column_name, restricted_users, batch_id)
+            for column_name, restricted_users in op["auditoria"]
+        )
+
+    with AuditWriter(bq_client, audit_table_ref) as auditoria:
+        ejecutar_tipo("actualizar_schema", actualizar_schema)
+
+    # 4. IAM: la política precalculada lleva el etag leído en el plan, así un cambio posterior hace fallar la escritura
+    def restringir_iam(op):
+        policy_tag_name = registro(op["destino"])[1][op["display_name"]]
+        if op["politica"]:
+            new_policy = policy_pb2.Policy.FromString(base64.b64decode(op["politica"]))
+        else:
+            policy = call_api("iam", datacatalog_client.get_iam_policy, request={"resource": policy_tag_name})
+            new_policy = build_restricted_policy(policy, {f"user:{u}" for u in op["restricted_users"]})
+            if new_policy is None:
+                return
+        try:
+            call_api("iam", datacatalog_client.set_iam_policy, request={"resource": policy_tag_name, "policy": new_policy})
+        except Aborted as e:
+            raise StalePlanError(f"La política IAM de {op['display_name']} cambió después de armar el plan") from e
+        METRICS.count("politicas_iam_actualizadas")
+
+    ejecutar_tipo("restringir_iam", restringir_iam)
+
+    # 5. Policy tags que ya no se usan. Como en la reconciliación, no se eliminan si quedaron schemas sin actualizar
+    # (fallidos o pendientes) en el mismo destino: sus columnas todavía apuntan a esos tags. Quedan pendientes en el
+    # checkpoint hasta que se completen los schemas.
+    bloqueados = {tuple(op["destino"]) for op in por_tipo["actualizar_schema"] if op["id"] not in completadas}
+    omitidas = [op for op in por_tipo["eliminar_policy_tag"] if tuple(op["destino"]) in bloqueados]
+    if omitidas:
+        print(f"Se omite la eliminación de {len(omitidas)} policy tags: hay schemas sin actualizar en sus destinos")
+        por_tipo["eliminar_policy_tag"] = [op for op in por_tipo["eliminar_policy_tag"] if tuple(op["destino"]) not in bloqueados]
+
+    def eliminar_tag(op):
+        try:
+            call_api("policy_tag", datacatalog_client.delete_policy_tag, name=op["policy_tag_name"])
+        except NotFound:
+            pass
+        registro(op["destino"])[1].pop(op["display_name"], None)
+        METRICS.count("policy_tags_eliminados")
+
+    ejecutar_tipo("eliminar_policy_tag", eliminar_tag)
+
+    guardar_registros()
+    if desactualizadas:
+        guardar_progreso()
+        raise StalePlanError(
+            f"Plan {plan['id']}: {len(desactualizadas)} operaciones sobre estado modificado después del plan "
+            f"({len(errores) - len(desactualizadas)} fallidas por otros errores), generar un plan nuevo con accion=plan"
+        )
+    if errores:
+        guardar_progreso()
+        raise RuntimeError(f"Plan {plan['id']}: {len(errores)} operaciones fallidas, se reintentan en el próximo apply")
+    print(f"Plan {plan['id']} aplicado: {len(completadas)} operaciones")
 
 # ---------------------------------------------------------------------
 # Cloud Function principal
+def run_report(estado, mensaje, codigo, modo=None, **campos):
+    # Resumen de la corrida: se emite como log estructurado, se exporta (METRICS_EXPORT_HOOK) y es la respuesta HTTP
+    resumen = {"estado": estado, "mensaje": mensaje, "modo": modo or MODO_EJECUCION, **campos, **METRICS.summary()}
+    log_event("resumen_corrida", severity="ERROR" if codigo >= 500 else "INFO", **resumen)
+    export_metrics(resumen)
+    return (json.dumps(resumen, ensure_ascii=False), codigo, {"Content-Type": "application/json; charset=utf-8"})
+
+def run_plan_action(accion):
+    # ?accion=plan carga el CSV (si cambió), arma el plan y lo guarda en PLAN_PATH; ?accion=apply ejecuta el plan
+    # guardado y lo elimina al completarse. Un apply sin tiempo suficiente deja el checkpoint y responde 202: el
+    # próximo apply continúa desde las operaciones pendientes. Un plan desactualizado responde 409 y se debe volver a
+    # planificar.
+    start_time_budget()
+    reset_metrics()
+    try:
+        if accion == "plan":
+            extraccion = extract_sheet_from_gcs()
+            if extraccion is None:
+                # La tabla de reglas ya refleja el CSV actual
+                fuente = read_sheet_metadata()[1]
+            else:
+                datos, fuente = extraccion
+                load_config_to_bq(datos)
+            plan = build_masking_plan(fuente)
+            save_plan(plan)
+            print(f"Plan {plan['id']} guardado en {PLAN_PATH}: {len(plan['operaciones'])} operaciones")
+            return run_report(
+                "planificado", f"Plan guardado en {PLAN_PATH}", 200, modo="plan",
+                plan={"id": plan["id"], "estimacion": plan["estimacion"]},
+            )
+
+        plan = read_plan()
+        if plan is None:
+            return run_report("error", f"No hay un plan guardado en {PLAN_PATH}", 404, modo="apply")
+        checkpoint = read_checkpoint("plan")
+        if checkpoint is None or checkpoint.get("plan_id") != plan["id"]:
+            checkpoint = {"modo": "plan", "fuente": plan["fuente"], "etapa": "apply_plan", "plan_id": plan["id"]}
+        try:
+            apply_masking_plan(plan, checkpoint)
+        except StalePlanError as e:
+            print(f"Plan desactualizado: {e}")
+            return run_report("desactualizado", str(e), 409, modo="apply", plan={"id": plan["id"]})
+        if plan["fuente"]:
+            record_config_source(plan["fuente"])
+        delete_checkpoint("plan")
+        delete_plan()
+        return run_report("completado", f"Plan {plan['id']} aplicado", 200, modo="apply", plan={"id": plan["id"]})
+    except TimeBudgetExceeded as e:
+        print(f"Tiempo de ejecución agotado, se continúa en el próximo apply: {e}")
+        return run_report("incompleto", f"Plan incompleto: {e}", 202, modo=accion)
+    except Exception as e:
+        print(f"Error: {e}")
+        return run_report("error", str(e), 500, modo=accion)
+
 def main(request):
+    # Cada invocación trabaja como máximo TIEMPO_LIMITE_SEG. Si queda trabajo pendiente responde 202 y deja el checkpoint
+    # en GCS: la siguiente invocación (reintento del scheduler o llamada manual) continúa sin volver a cargar el CSV ni
+    # a limpiar las políticas. ?accion=plan / ?accion=apply separan la planificación de la ejecución (run_plan_action).
+    accion = request.args.get("accion") if request is not None else None
+    if accion in ("plan", "apply"):
+        return run_plan_action(accion)
+
+    start_time_budget()
+    reset_metrics()
     try:
-        extract_sheet_from_gcs()
-        load_config_to_bq()
-        clear_existing_policies()
-        apply_masking_from_config()
+        checkpoint = read_checkpoint()
+        if checkpoint is not None and checkpoint.get("modo") == MODO_EJECUCION and checkpoint.get("fuente") == read_sheet_metadata()[1]:
+            fuente = checkpoint["fuente"]
+            print(f"Retomando corrida interrumpida en la etapa '{checkpoint['etapa']}' (checkpoint {checkpoint['actualizado']})")
+        else:
+            # Sin checkpoint, o el CSV cambió desde la corrida interrumpida: se empieza de cero
+            extraccion = extract_sheet_from_gcs()
+            if extraccion is None:
+                print("El archivo de reglas no cambió desde la última corrida: se omiten la carga y la aplicación")
+                return run_report("sin_cambios", "Sin cambios en las reglas de Masking", 200)
+            datos, fuente = extraccion
+            load_config_to_bq(datos)
+            checkpoint = {"fuente": fuente, "modo": MODO_EJECUCION, "etapa": MODO_EJECUCION if MODO_EJECUCION == "reconcile" else "clear"}
+            save_checkpoint(checkpoint)
+
+        if MODO_EJECUCION == "reconcile":
+            reconcile_masking_policies(checkpoint)
+        else:
+            if checkpoint["etapa"] == "clear":
+                clear_existing_policies()
+                checkpoint["etapa"] = "apply"
+                save_checkpoint(checkpoint)
+            apply_masking_from_config(checkpoint)
+        record_config_source(fuente)
+        delete_checkpoint()
         print("Proceso completado correctamente")
-        return ("Proceso de Masking completado", 200)
+        return run_report("completado", "Proceso de Masking completado", 200)
+    except TimeBudgetExceeded as e:
+        print(f"Tiempo de ejecución agotado, se continúa en la próxima invocación: {e}")
+        return run_report("incompleto", f"Proceso de Masking incompleto: {e}", 202)
+    except Exception as e:
+        print(f"Error: {e}")
+        return run_report("error", str(e), 500)
+
+# ---------------------------------------------------------------------
+# Cloud Function por eventos: se despliega con --trigger-event=google.storage.object.finalize sobre BUCKET_NAME y
+# procesa solo las reglas que cambiaron entre la última generación aplicada del CSV (labels de la tabla de reglas) y la
+# generación del evento. Requiere el versionado del bucket para leer la generación anterior; sin ella, o con una
+# corrida interrumpida pendiente, se ejecuta el proceso completo de main().
+def read_rules_generation(generation):
+    bucket = get_storage_client().bucket(BUCKET_NAME.replace("gs://", ""))
+    return read_rules_csv(bucket.blob(SHEET_PATH, generation=int(generation)))
+
+def compute_rules_delta(anteriores, actuales):
+    # Diferencias a nivel de fila entre dos versiones de las reglas (salida de read_rules_csv)
+    return {
+        "agregadas": {clave: fila for clave, fila in actuales.items() if clave not in anteriores},
+        "eliminadas": {clave: fila for clave, fila in anteriores.items() if clave not in actuales},
+        "modificadas": {
+            clave: (anteriores[clave], fila)
+            for clave, fila in actuales.items() if clave in anteriores and anteriores[clave] != fila
+        },
+    }
+
+def event_expired(context):
+    # Con --retry GCS reentrega el evento durante días: pasado EVENTO_REINTENTO_MAX_SEG se deja de reintentar y el
+    # cambio queda para la próxima corrida de main(), que detecta la generación no registrada
+    timestamp = getattr(context, "timestamp", None)
+    if not timestamp:
+        return False
+    edad = (datetime.now(timezone.utc) - datetime.fromisoformat(timestamp.replace("Z", "+00:00"))).total_seconds()
+    return edad > EVENTO_REINTENTO_MAX_SEG
+
+def event_response(respuesta, context):
+    # respuesta: salida de run_report. Una función en segundo plano solo se reintenta si lanza una excepción, así que
+    # un 202 (tiempo agotado, con checkpoint) o un error se convierten en excepción para que el evento se reentregue
+    # y la siguiente invocación continúe
+    cuerpo, codigo, _ = respuesta
+    if (codigo == 202 or codigo >= 500) and not event_expired(context):
+        raise RuntimeError(f"Evento incompleto ({codigo}), se reintenta: {cuerpo[:500]}")
+    return respuesta
+
+def main_gcs_event(event, context):
+    if event.get("name") != SHEET_PATH:
+        print(f"Evento ignorado: gs://{event.get('bucket')}/{event.get('name')}")
+        return None
+    return event_response(apply_gcs_event(event), context)
+
+def apply_gcs_event(event):
+    start_time_budget()
+    reset_metrics()
+    checkpoint = None
+    try:
+        fuente = source_from_object(event["generation"], event.get("md5Hash"), event.get("crc32c"))
+        anterior = read_config_source()
+        if anterior and anterior["generation"] and int(anterior["generation"]) >= int(fuente["generation"]):
+            # Evento repetido o fuera de orden: esa generación (o una posterior) ya fue aplicada
+            return run_report("sin_cambios", f"Generación {fuente['generation']} ya procesada", 200, modo="delta")
+        checkpoint = read_checkpoint()
+        if not (anterior and anterior["generation"]) or config_changed(anterior) or (checkpoint is not None and checkpoint.get("modo") != "delta"):
+            print("Sin generación anterior aplicada, con otra configuración o con una corrida interrumpida: se ejecuta el proceso completo")
+            return main(None)
+        try:
+            filas_anteriores, _ = read_rules_generation(anterior["generation"])
+        except NotFound:
+            print(f"La generación {anterior['generation']} ya no existe (¿versionado deshabilitado?): se ejecuta el proceso completo")
+            return main(None)
+
+        # Un delta interrumpido de la misma generación se retoma (mismo batch_id, IAM ya verificado); el de otra
+        # generación se descarta, ya que el delta se vuelve a calcular desde la última generación registrada
+        if checkpoint is None or checkpoint.get("fuente") != fuente:
+            checkpoint = {"modo": "delta", "fuente": fuente, "etapa": "delta"}
+        else:
+            print(f"Retomando delta interrumpido de la generación {fuente['generation']} (checkpoint {checkpoint['actualizado']})")
+
+        filas, descartadas = read_rules_generation(fuente["generation"])
+        delta = compute_rules_delta(filas_anteriores, filas)
+        METRICS.count("filas_csv", len(filas))
+        METRICS.count("filas_descartadas", descartadas)
+        for tipo, reglas in delta.items():
+            METRICS.count(f"reglas_{tipo}", len(reglas))
+        print(
+            f"Generación {anterior['generation']} -> {fuente['generation']}: {len(delta['agregadas'])} reglas agregadas, "
+            f"{len(delta['eliminadas'])} eliminadas, {len(delta['modificadas'])} modificadas"
+        )
+
+        # La tabla de reglas siempre refleja el CSV completo; solo la aplicación se limita al delta
+        load_config_to_bq(rules_to_ndjson(filas))
+        if any(delta.values()):
+            reconcile_masking_policies(checkpoint, delta=delta)
+        record_config_source(fuente)
+        delete_checkpoint()
+        return run_report("completado", "Cambios de las reglas de Masking aplicados", 200, modo="delta")
+    except TimeBudgetExceeded as e:
+        # Se guarda el checkpoint y no se registra la generación: el evento reentregado retoma el delta
+        print(f"Tiempo de ejecución agotado aplicando el delta: {e}")
+        if checkpoint is not None:
+            save_checkpoint(checkpoint)
+        return run_report("incompleto", f"Delta incompleto, se retoma al reintentar el evento: {e}", 202, modo="delta")
     except Exception as e:
         print(f"Error: {e}")
-        return (str(e), 500)
+        return run_report("error", str(e), 500, modo="delta")
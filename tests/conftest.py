@@ -0,0 +1,48 @@
+# -------------------------------------------------------------------------------------------------------------------
+# Fixtures de los tests: main.py corre contra el backend falso de benchmarks/fake_backend.py (sin proyecto de GCP).
+# Requiere las dependencias de requirements.txt instaladas (se usan los tipos reales del SDK).
+import argparse
+import itertools
+import os
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "benchmarks"))
+
+import bench_pipeline
+import main
+
+@pytest.fixture
+def pipeline():
+    # Los tests y bench_pipeline.preparar modifican los parámetros del módulo: se restauran al terminar cada test
+    parametros = {nombre: valor for nombre, valor in vars(main).items() if nombre.isupper()}
+    yield main
+    for nombre, valor in parametros.items():
+        setattr(main, nombre, valor)
+
+@pytest.fixture
+def backend(pipeline):
+    # Devuelve una función que arma el backend falso con reglas sintéticas: tablas de columnas_por_tabla columnas
+    # repartidas entre los destinos. Con un único worker el orden de las llamadas es determinístico.
+    def preparar(columnas=40, columnas_por_tabla=5, destinos=1, esquema_policy_tags="columna"):
+        args = argparse.Namespace(
+            latencia_ms=0, latencia_metodo=[], columnas_por_tabla=columnas_por_tabla, grupos_usuarios=4,
+            destinos=destinos, workers=1, esquema_policy_tags=esquema_policy_tags, con_limites=False,
+        )
+        backend, _ = bench_pipeline.preparar(args, columnas)
+        return backend
+    return preparar
+
+@pytest.fixture
+def interrumpir(pipeline, monkeypatch):
+    # Simula que el plazo de la invocación se agota después de `controles` consultas a time_budget_exceeded.
+    # Con None el plazo no se agota (la invocación siguiente completa el trabajo).
+    def interrumpir(controles):
+        contador = itertools.count()
+        monkeypatch.setattr(
+            pipeline, "time_budget_exceeded", lambda: controles is not None and next(contador) >= controles,
+        )
+    return interrumpir
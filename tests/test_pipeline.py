@@ -0,0 +1,163 @@
+import pytest
+from google.cloud import bigquery
+
+import bench_pipeline
+
+TAG_AJENO = "projects/otro/locations/us/taxonomies/999/policyTags/1"
+
+def regla(display_name, *usuarios):
+    return {"policy_tag_display_name": display_name, "restricted_users": list(usuarios)}
+
+def fila(restricted_users):
+    return {
+        "project_id": "p", "dataset_id": "d", "table_id": "t", "column_name": "c", "restricted_users": restricted_users,
+    }
+
+def columnas_con_tag(backend, sufijo):
+    return {
+        (table_ref, field.name): list(field.policy_tags.names)
+        for table_ref, table in backend.bigquery.tablas.items() if sufijo in table_ref
+        for field in table.schema if field.policy_tags and field.policy_tags.names
+    }
+
+def filas_auditoria(pipeline, backend):
+    return backend.bigquery.datos.get(f"{pipeline.PROJECT_ID}.{pipeline.BQ_DATASET}.{pipeline.BQ_AUDIT_TABLE}", [])
+
+def modificar_reglas(pipeline, backend):
+    # Nueva generación del CSV (mismo contenido): la corrida siguiente no se omite por "sin cambios"
+    bucket = backend.storage.bucket(pipeline.BUCKET_NAME.replace("gs://", ""))
+    bucket.guardar(pipeline.SHEET_PATH, bucket.objetos[pipeline.SHEET_PATH][0] + "\n")
+
+# -------------------------------------------------------------------------------------------------------------------
+# Diff de la reconciliación y delta de reglas
+def test_compute_reconcile_diff(pipeline):
+    reglas = {
+        ("p", "d", "t", "sin_cambios"): regla("t_sin_cambios_mask", "a@x.com"),
+        ("p", "d", "t", "nueva"): regla("t_nueva_mask", "a@x.com"),
+        ("p", "d", "t", "otro_tag"): regla("t_otro_tag_mask", "b@x.com"),
+        ("p", "d", "t", "registro"): regla("t_registro_mask", "a@x.com"),
+        ("p", "d", "inexistente", "c"): regla("inexistente_c_mask", "a@x.com"),
+    }
+    estado = {
+        "tags": {"t_sin_cambios_mask": "tax/1", "t_otro_tag_mask": "tax/2", "viejo_mask": "tax/9"},
+        "tablas": {"p.d.t"},
+        "campos": {"p.d.t": {"sin_cambios", "nueva", "otro_tag", "sobrante"}},
+        "columnas_con_tag": {
+            ("p.d.t", "sin_cambios"): "tax/1",
+            ("p.d.t", "otro_tag"): "tax/9",
+            ("p.d.t", "sobrante"): "tax/9",
+        },
+    }
+
+    diff = pipeline.compute_reconcile_diff(reglas, estado)
+
+    assert diff["crear_tags"] == ["inexistente_c_mask", "t_nueva_mask", "t_registro_mask"]
+    assert diff["eliminar_tags"] == ["viejo_mask"]
+    # Ni la columna ya correcta ni los campos inexistentes (o RECORD) ni las tablas inexistentes generan cambios
+    assert diff["cambios_por_tabla"] == {
+        "p.d.t": {"nueva": "t_nueva_mask", "otro_tag": "t_otro_tag_mask", "sobrante": None},
+    }
+
+def test_compute_reconcile_diff_sin_cambios(pipeline):
+    reglas = {("p", "d", "t", "c"): regla("t_c_mask", "a@x.com")}
+    estado = {
+        "tags": {"t_c_mask": "tax/1"},
+        "tablas": {"p.d.t"},
+        "campos": {"p.d.t": {"c"}},
+        "columnas_con_tag": {("p.d.t", "c"): "tax/1"},
+    }
+
+    assert pipeline.compute_reconcile_diff(reglas, estado) == {"crear_tags": [], "eliminar_tags": [], "cambios_por_tabla": {}}
+
+def test_compute_rules_delta(pipeline):
+    anteriores = {("p", "d", "t", "igual"): fila("a@x.com"), ("p", "d", "t", "vieja"): fila("a@x.com"), ("p", "d", "t", "cambia"): fila("a@x.com")}
+    actuales = {("p", "d", "t", "igual"): fila("a@x.com"), ("p", "d", "t", "nueva"): fila("b@x.com"), ("p", "d", "t", "cambia"): fila("b@x.com")}
+
+    delta = pipeline.compute_rules_delta(anteriores, actuales)
+
+    assert delta == {
+        "agregadas": {("p", "d", "t", "nueva"): fila("b@x.com")},
+        "eliminadas": {("p", "d", "t", "vieja"): fila("a@x.com")},
+        "modificadas": {("p", "d", "t", "cambia"): (fila("a@x.com"), fila("b@x.com"))},
+    }
+    assert pipeline.compute_rules_delta(actuales, actuales) == {"agregadas": {}, "eliminadas": {}, "modificadas": {}}
+
+# -------------------------------------------------------------------------------------------------------------------
+# Corridas interrumpidas por el plazo de la invocación
+@pytest.mark.parametrize("modo", ["full", "reconcile"])
+def test_corrida_retomada_conserva_batch_id(pipeline, backend, interrumpir, modo):
+    backend = backend(columnas=40, columnas_por_tabla=5)
+    pipeline.MODO_EJECUCION = modo
+    pipeline.CHECKPOINT_CADA_TABLAS = 2
+
+    # La primera invocación se corta durante la actualización de los schemas
+    interrumpir(44)
+    _, codigo, _ = pipeline.main(None)
+    checkpoint = pipeline.read_checkpoint()
+    assert codigo == 202
+    assert checkpoint["modo"] == modo and checkpoint["batch_id"] == 1
+    assert 0 < len(columnas_con_tag(backend, "tabla_")) < 40
+
+    interrumpir(None)
+    _, codigo, _ = pipeline.main(None)
+    assert codigo == 200
+    assert pipeline.read_checkpoint() is None
+    assert len(columnas_con_tag(backend, "tabla_")) == 40
+    # Cada columna se audita una sola vez y toda la corrida comparte el batch_id del checkpoint
+    auditoria = filas_auditoria(pipeline, backend)
+    assert len(auditoria) == 40
+    assert {f["batch_id"] for f in auditoria} == {1}
+    assert backend.recorder.llamadas["datacatalog.set_iam_policy"] > 0
+
+def test_retomar_no_repite_revocaciones(pipeline, backend, interrumpir):
+    backend = backend(columnas=40, columnas_por_tabla=5)
+    pipeline.MODO_EJECUCION = "full"
+
+    # Se corta en la etapa de IAM, después de revocar los accesos de algunos tags
+    interrumpir(55)
+    _, codigo, _ = pipeline.main(None)
+    verificados = pipeline.read_checkpoint()["iam_completados"]
+    assert codigo == 202 and 0 < len(verificados) < 40
+
+    interrumpir(None)
+    _, codigo, _ = pipeline.main(None)
+    assert codigo == 200
+    assert backend.recorder.llamadas["datacatalog.get_iam_policy"] == 40
+
+# -------------------------------------------------------------------------------------------------------------------
+# Limpieza del modo full
+def test_limpieza_full_conserva_tags_de_otras_taxonomias(pipeline, backend):
+    backend = backend(columnas=12, columnas_por_tabla=3, destinos=2)
+    for table_ref in (f"{bench_pipeline.PROJECT_ID}.{bench_pipeline.BQ_DATASET}.ajena", f"{bench_pipeline.PROJECT_ID}-1.{bench_pipeline.BQ_DATASET}.ajena"):
+        backend.bigquery.add_table(table_ref, [
+            bigquery.SchemaField("dni", "STRING", policy_tags=bigquery.PolicyTagList([TAG_AJENO])),
+            bigquery.SchemaField("libre", "STRING"),
+        ])
+    pipeline.MODO_EJECUCION = "full"
+
+    for _ in range(2):
+        modificar_reglas(pipeline, backend)
+        _, codigo, _ = pipeline.main(None)
+        assert codigo == 200
+        assert columnas_con_tag(backend, ".ajena") == {
+            (f"{bench_pipeline.PROJECT_ID}.{bench_pipeline.BQ_DATASET}.ajena", "dni"): [TAG_AJENO],
+            (f"{bench_pipeline.PROJECT_ID}-1.{bench_pipeline.BQ_DATASET}.ajena", "dni"): [TAG_AJENO],
+        }
+        assert len(columnas_con_tag(backend, "tabla_")) == 12
+
+# -------------------------------------------------------------------------------------------------------------------
+# Lectura del CSV
+def test_csv_con_bom_y_filas_repetidas(pipeline, backend):
+    backend = backend(columnas=10, columnas_por_tabla=5)
+    bucket = backend.storage.bucket(pipeline.BUCKET_NAME.replace("gs://", ""))
+    encabezado, *filas = bucket.objetos[pipeline.SHEET_PATH][0].splitlines()
+    encabezado = ", ".join(encabezado.split(","))
+    repetida = filas[0].rsplit(",", 1)[0] + ',"otro@example.com"'
+    bucket.guardar(pipeline.SHEET_PATH, "﻿" + "\n".join([encabezado, *filas, repetida]) + "\n")
+
+    pipeline.reset_metrics()
+    datos, _ = pipeline.extract_sheet_from_gcs()
+
+    assert len(datos.read().splitlines()) == 10
+    assert pipeline.METRICS.contadores["filas_descartadas"] == 1
+    assert "otro@example.com" not in datos.getvalue().decode("utf-8")